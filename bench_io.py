@@ -0,0 +1,112 @@
+#! /usr/bin/python3
+""" IO benchmarks
+Times the fasta parsing backends in io.py against each other on a synthetic
+GISAID-style fasta, and bulk_insert() against update_main() on a sqlite db.
+
+Usage:
+$ python3 bench_io.py fasta --n_records 1000000 --seq_len 100
+$ python3 bench_io.py sqlite --n_records 1000000 --seq_len 100
+
+Don Teng, 24 May 2017
+"""
+
+import os
+import sys
+import time
+import random
+import sqlite3
+import tempfile
+import argparse
+
+from io_loader import load_cb_io
+
+
+""" ============== DEFS ============== """
+
+def write_synthetic_fasta(fn, n_records, seq_len, line_width=70, seed=0):
+    """Writes n_records random records with GISAID-style headers:
+    Isolate ID|Isolate name|Lineage|Collection date
+    """
+    rng = random.Random(seed)
+    with open(fn, "w", buffering=1 << 20) as f:
+        for i in range(n_records):
+            seq = "".join(rng.choice("acgt") for _ in range(seq_len))
+            f.write(">EPI_ISL_%d|A/Synthetic/%d/2017|H3N2|2017-05-24\n" % (i, i))
+            for j in range(0, seq_len, line_width):
+                f.write(seq[j:j+line_width] + "\n")
+
+
+def bench_fasta(cb_io, fn, backends=("native", "seqio")):
+    """Parses fn once per backend, and prints records/second."""
+    for backend in backends:
+        t0 = time.perf_counter()
+        n = 0
+        for row in cb_io.iter_fasta(fn, backend=backend):
+            n += 1
+        dt = time.perf_counter() - t0
+        print("%-8s %10d records  %8.2f s  %12.0f records/s" % (backend, n, dt, n/dt))
+
+
+def bench_sqlite(cb_io, db_fn, n_records, seq_len, n_slow=10000, seed=0):
+    """Loads n_records synthetic rows into an indexed 'main' table with
+    bulk_insert(), and n_slow rows with update_main() (which commits every
+    row, so it gets fewer rows), and prints rows/second for each.
+    """
+    rng = random.Random(seed)
+    seq = "".join(rng.choice("acgt") for _ in range(seq_len))
+    rows = [{"name_id": "A/Synthetic/%d/2017|EPI_ISL_%d" % (i, i),
+             "segment": "HA",
+             "location": "Asia / Singapore",
+             "cdate": "2017-05-24",
+             "seq": seq}
+            for i in range(n_records)]
+
+    for name, n in [("update_main", min(n_slow, n_records)), ("bulk_insert", n_records)]:
+        if os.path.exists(db_fn):
+            os.remove(db_fn)
+        conn = sqlite3.connect(db_fn)
+        conn.execute("CREATE TABLE main (name_id TEXT, segment TEXT, location TEXT, cdate TEXT, seq TEXT)")
+        conn.execute("CREATE INDEX main_name_id ON main (name_id)")
+        t0 = time.perf_counter()
+        if name == "update_main":
+            for row in rows[:n]:
+                cb_io.update_main(row, conn)
+        else:
+            cb_io.bulk_insert(conn, rows, fast_pragmas=True)
+        dt = time.perf_counter() - t0
+        conn.close()
+        print("%-12s %10d rows  %8.2f s  %12.0f rows/s" % (name, n, dt, n/dt))
+
+
+""" ============== ARGPARSE ============== """
+
+parser = argparse.ArgumentParser(description="Benchmarks for io.py")
+parser.add_argument("bench", choices=["fasta", "sqlite"], help="which benchmark to run")
+parser.add_argument("--n_records", type=int, default=1000000)
+parser.add_argument("--seq_len", type=int, default=100)
+parser.add_argument("--fasta", default=None,
+                    help="benchmark on an existing fasta instead of a synthetic one")
+parser.add_argument("--n_slow", type=int, default=10000,
+                    help="no. of rows to load with update_main() in the sqlite benchmark")
+
+
+""" ============== PROC ============== """
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    cb_io = load_cb_io()
+
+    if args.bench == "fasta":
+        if args.fasta is not None:
+            bench_fasta(cb_io, args.fasta)
+        else:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                fn = os.path.join(tmp_dir, "synthetic.fasta")
+                print("Writing %s synthetic records of length %s..." % (args.n_records, args.seq_len))
+                write_synthetic_fasta(fn, args.n_records, args.seq_len)
+                bench_fasta(cb_io, fn)
+
+    elif args.bench == "sqlite":
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            bench_sqlite(cb_io, os.path.join(tmp_dir, "bench.db"), args.n_records, args.seq_len,
+                         n_slow=args.n_slow)
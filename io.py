@@ -3,49 +3,218 @@ some data wrangling tools.
 """
 
 import os
+import re
+import gzip
+import json
+import contextlib
+import mmap
+import hashlib
+import tempfile
+import itertools
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import numpy as np
 
 from Bio import SeqIO
 # from Bio.SeqFeature import SeqFeature, FeatureLocation
 
-
-def read_fasta(fn, verbose=False):
-    """Reads a fasta into a list of lists, where each list is one record.
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    # cached_read_*() falls back to .npz caches
+    pa = None
+
+try:
+    import zstandard
+except ImportError:
+    # write_fasta() can't write .zst files
+    zstandard = None
+
+# Loaded fasta indexes, keyed by (abs path, key_fields, sep).
+_FASTA_INDEX_CACHE = {}
+
+# Metadata read by get_meta_from_csv(cache=True), keyed by (abs path, meta_cols).
+_META_CACHE = {}
+
+# Loaded country -> region indexes, keyed by (abs path, aliases).
+_REGION_INDEX_CACHE = {}
+
+# Other spellings of the countries in cc_dict.json.
+_COUNTRY_ALIASES = {"Republic of Korea": "South Korea",
+                    "Viet Nam": "Vietnam",
+                    "Lao PDR": "Laos",
+                    "Burma": "Myanmar",
+                    "Macau": "Macao",
+                    "Brunei Darussalam": "Brunei",
+                    "Timor-Leste": "East Timor",
+                    "Russian Federation": "Russia",
+                    "Iran (Islamic Republic of)": "Iran",
+                    "Syrian Arab Republic": "Syria",
+                    "Turkiye": "Turkey",
+                    "Kyrgyz Republic": "Kyrgyzstan",
+                    "State of Palestine": "Palestine"}
+
+# Renaming of the GISAID metadata csv columns.
+_META_RENAME = {"Isolate_Name": "iso_name",
+                "Isolate_Id": "iso_id",
+                "Collection_Date": "cdate",
+                "Location": "location"}
+
+
+def iter_fasta(fn, verbose=False, backend='native'):
+    """Streams a fasta one record at a time. Each record is yielded as a list
+    of the '|'-delimited header fields followed by the sequence, with
+    whitespace already stripped from every field. Only one record is held in
+    memory at a time.
 
     Params
     ------
     fn: string; filename
-    verbose: boolean; verbosity.
+    verbose: boolean; prints a preview of the first 5 records.
+    backend: str; 'native' scans the raw bytes of the file directly, 'seqio'
+        goes through Bio.SeqIO. Both give the same records for well-formed
+        fasta files; 'native' is roughly twice as fast.
 
-    Returns
-    -------
-    contents: a list of lists.
+    Yields
+    ------
+    row: list of str; header fields + [seq].
     """
     print_limit = 0
-    contents = []
-    for record in SeqIO.parse(fn, "fasta"):
-        header = record.description
-        seq = str(record.seq)
-        row = header.split("|") + [seq]
-        contents.append(row)
+    for header, seq in _iter_fasta_records(fn, backend):
+        # strip whitespaces, which GISAID tends to add
+        row = [field.strip() for field in header.split("|")] + [seq.strip()]
         if verbose:
             if print_limit < 5:
                 preview_seq = row[-1][:10] + "..."
                 print_row = row[:-1] + [preview_seq]
                 print(print_row)
                 print_limit +=1
+        yield row
 
-    # strip whitespaces, which GISAID tends to add
-    for i in range(len(contents)):
-        for j in range(len(contents[i])):
-            contents[i][j] = contents[i][j].strip()
 
-    return contents
+def _iter_fasta_records(fn, backend='native'):
+    """Yields (header, seq) string pairs from a fasta, where header is the
+    full description line without the leading '>'.
+    """
+    if backend == 'native':
+        return _iter_fasta_native(fn)
+    elif backend == 'seqio':
+        return ((record.description, str(record.seq))
+                for record in SeqIO.parse(fn, "fasta"))
+    else:
+        raise ValueError("Unknown fasta backend: %s" % backend)
+
+
+def _iter_fasta_native(fn, block_size=1 << 22):
+    """Fast-path fasta parser. Reads the file in large binary blocks and
+    splits each block into records on '\n>' boundaries, so that no Bio.SeqIO
+    objects are constructed and newlines are removed from each sequence in a
+    single bytes.translate() call. Anything before the first '>' is ignored.
+    """
+    with open(fn, 'rb') as f:
+        carry = None
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            if carry is None:
+                # skip anything before the first record
+                if block[:1] != b">":
+                    i = block.find(b"\n>")
+                    if i == -1:
+                        continue
+                    block = block[i+1:]
+                buf = block[1:]
+            else:
+                buf = carry + block
+            recs = buf.split(b"\n>")
+            # the last record may continue into the next block
+            carry = recs.pop()
+            for rec in recs:
+                header, _, seq = rec.partition(b"\n")
+                yield header.decode().rstrip(), seq.translate(None, b"\r\n \t").decode()
+        if carry is not None:
+            header, _, seq = carry.partition(b"\n")
+            yield header.decode().rstrip(), seq.translate(None, b"\r\n \t").decode()
+
+
+def iter_fasta_chunks(fn, chunk_size=100000, cols=None, verbose=False,
+                      backend='native'):
+    """Streams a fasta in batches of chunk_size records. Each batch is column
+    oriented: a dict mapping column name -> numpy object array, which can be
+    handed straight to pd.DataFrame().
+
+    Records with fewer header fields than the widest record in the batch are
+    padded with '' so that every column has the same length.
+
+    Params
+    ------
+    fn: string; filename
+    chunk_size: int; max. no. of records per batch.
+    cols: list of str; names for the header fields. Defaults to
+        'col0', 'col1', ... The sequence column is always named 'seq'.
+    verbose: boolean; verbosity, passed to iter_fasta().
+    backend: str; 'native' or 'seqio', passed to iter_fasta().
+
+    Yields
+    ------
+    chunk: dict of {col_name: np.array}, each of length <= chunk_size.
+    """
+    rows = []
+    for row in iter_fasta(fn, verbose=verbose, backend=backend):
+        rows.append(row)
+        if len(rows) == chunk_size:
+            yield _rows_to_columns(rows, cols)
+            rows = []
+    if len(rows) > 0:
+        yield _rows_to_columns(rows, cols)
+
+
+def _rows_to_columns(rows, cols=None):
+    """Transposes a list of [header fields..., seq] rows into a dict of
+    column arrays. Helper for iter_fasta_chunks().
+    """
+    n_fields = max(len(row) for row in rows) - 1
+    if cols is None:
+        cols = ["col" + str(i) for i in range(n_fields)]
+    elif len(cols) < n_fields:
+        raise ValueError("Got %s header column names, but records have up to "
+                         "%s header fields" % (len(cols), n_fields))
+
+    chunk = {}
+    for i in range(len(cols)):
+        col_arr = np.empty(len(rows), dtype=object)
+        col_arr[:] = [row[i] if i < len(row) - 1 else "" for row in rows]
+        chunk[cols[i]] = col_arr
+    seq_arr = np.empty(len(rows), dtype=object)
+    seq_arr[:] = [row[-1] for row in rows]
+    chunk["seq"] = seq_arr
+    return chunk
+
+
+def read_fasta(fn, verbose=False, backend='native'):
+    """Reads a fasta into a list of lists, where each list is one record.
+    Thin wrapper around iter_fasta(); prefer iter_fasta() or
+    iter_fasta_chunks() for large files.
+
+    Params
+    ------
+    fn: string; filename
+    verbose: boolean; verbosity.
+    backend: str; 'native' or 'seqio'. See iter_fasta().
+
+    Returns
+    -------
+    contents: a list of lists.
+    """
+    return list(iter_fasta(fn, verbose=verbose, backend=backend))
 
 
 def prep_fasta_contents(d0_in, header_cols, seq_col='seq', preview=0):
     """Reads a dataframe into a list of lists, in fasta format.
+    Prefer write_fasta(), which streams the records straight to a file
+    instead of holding all of them in memory.
 
     Params
     ------
@@ -63,12 +232,8 @@ def prep_fasta_contents(d0_in, header_cols, seq_col='seq', preview=0):
     print("WARNING: column selection logic changed: user now specifies columns to place in header!")
 
     contents = []
-    for index, row in d0_in.iterrows():
-        header_ls = row[header_cols]
-        header_ls = [str(item) for item in header_ls]
-        fasta_header = ">" + "|".join(header_ls)
-        seq = str(row[seq_col])
-        contents.append(fasta_header)
+    for header, seq in _iter_fasta_entries(d0_in, header_cols, seq_col):
+        contents.append(">" + header)
         contents.append(seq)
 
     # display contents
@@ -82,7 +247,119 @@ def prep_fasta_contents(d0_in, header_cols, seq_col='seq', preview=0):
     return contents
 
 
-def read_flu_data(fn, fmt='fasta'):
+def write_fasta(df, fn, header_cols, seq_col='seq', line_width=None, compression='infer',
+                skip_na=False, chunk_size=10000, buffer_size=1 << 22):
+    """Streams the rows of a dataframe to a fasta file, one chunk of records
+    at a time, so that the file's contents are never all held in memory.
+
+    Params
+    ------
+    df: input dataframe.
+    fn: str, or a file object opened in binary mode.
+    header_cols: list of str; columns to place in the header, '|'-delimited.
+    seq_col: str; the column with the sequences.
+    line_width: int; wrap sequences to this many chars per line. Default =
+        one line per sequence.
+    compression: str; 'gzip', 'zstd' (needs the zstandard package), None,
+        or 'infer' from fn's extension (.gz, .zst).
+    skip_na: boolean; leave out records with no sequence.
+    chunk_size: int; no. of records formatted per write.
+    buffer_size: int; size of the file's write buffer, in bytes.
+
+    Returns
+    -------
+    n: int; no. of records written.
+    """
+    n = 0
+    with open_fasta_out(fn, compression, buffer_size) as f:
+        parts = []
+        for header, seq in _iter_fasta_entries(df, header_cols, seq_col, skip_na=skip_na,
+                                               chunk_size=chunk_size):
+            if line_width is not None and len(seq) > line_width:
+                seq = "\n".join([seq[i:i+line_width] for i in range(0, len(seq), line_width)])
+            parts.append(">%s\n%s\n" % (header, seq))
+            if len(parts) == chunk_size:
+                f.write("".join(parts).encode())
+                n += len(parts)
+                parts = []
+        f.write("".join(parts).encode())
+        n += len(parts)
+    return n
+
+
+def write_fasta_by_segment(df, fn_pattern, header_cols, seg_cols, n_jobs=4, **kwargs):
+    """Writes one fasta per segment column of a pivoted dataframe (see
+    pivot_raw_tbl()), in parallel threads. Isolates missing a segment are
+    left out of that segment's file.
+
+    Params
+    ------
+    df: pivoted dataframe.
+    fn_pattern: str; output path with a '{}' for the segment, e.g.
+        'out/gisaid_{}.fasta.gz'.
+    header_cols: list of str; see write_fasta().
+    seg_cols: list of str; the segment columns, e.g. ['HA', 'NA'].
+    n_jobs: int; no. of files written at once.
+    kwargs: passed to write_fasta().
+
+    Returns
+    -------
+    n_written: dict of {segment: no. of records written}.
+    """
+    kwargs["skip_na"] = True
+    with ThreadPoolExecutor(max_workers=n_jobs) as ex:
+        futures = {seg: ex.submit(write_fasta, df, fn_pattern.format(seg), header_cols,
+                                  seq_col=seg, **kwargs)
+                   for seg in seg_cols}
+        return {seg: future.result() for seg, future in futures.items()}
+
+
+def _iter_fasta_entries(df, header_cols, seq_col, skip_na=False, chunk_size=10000):
+    """Yields (header, seq) string pairs from the columns of a dataframe,
+    converting chunk_size rows at a time.
+
+    Values are converted with the frame's common row dtype, as
+    df.iterrows() does, so that the headers match those of the original,
+    row-by-row prep_fasta_contents(): e.g. an int column is written as '1.0'
+    if all the other columns are floats, and as '1' otherwise.
+    """
+    row_dtype = df.iloc[:0].to_numpy().dtype
+    if row_dtype.kind in "biufc":
+        to_values = lambda col: col.to_numpy(dtype=row_dtype).astype(object)
+    else:
+        to_values = lambda col: col.to_numpy(dtype=object)
+    for start in range(0, df.shape[0], chunk_size):
+        chunk = df.iloc[start:start + chunk_size]
+        header_arrs = [[str(v) for v in to_values(chunk[col])] for col in header_cols]
+        seqs = to_values(chunk[seq_col])
+        for fields, seq in zip(zip(*header_arrs), seqs):
+            if skip_na and not isinstance(seq, str):
+                continue
+            yield "|".join(fields), str(seq)
+
+
+def open_fasta_out(fn, compression='infer', buffer_size=1 << 22):
+    """Opens fn for writing bytes, compressed as asked (see write_fasta()),
+    e.g. to write several batches of records to one file. If fn is already a
+    file object, it is left open afterwards.
+    """
+    if not isinstance(fn, str):
+        return contextlib.nullcontext(fn)
+    if compression == 'infer':
+        compression = {".gz": "gzip", ".zst": "zstd"}.get(os.path.splitext(fn)[1])
+    if compression == 'gzip':
+        return gzip.open(fn, 'wb', compresslevel=6)
+    elif compression == 'zstd':
+        if zstandard is None:
+            raise ImportError("Writing .zst files needs the zstandard package")
+        return zstandard.ZstdCompressor().stream_writer(open(fn, 'wb', buffering=buffer_size))
+    elif compression is None:
+        return open(fn, 'wb', buffering=buffer_size)
+    else:
+        raise ValueError("Unknown compression: %s" % compression)
+
+
+def read_flu_data(fn, fmt='fasta', backend='native'):
     """Reads a file, duh.
     For the moment, this function only works for flu data; that is, the
     name of the virus contains all relevant meta-data, so that we need only
@@ -93,6 +370,7 @@ def read_flu_data(fn, fmt='fasta'):
     fn: str. Path to file.
     fmt: file format. So far, extensions are 'fasta', 'genbank', 'txt'.
     In particular, 'txt' files are still expected to have a fasta-like format.
+    backend: str; fasta parser, 'native' or 'seqio'. See iter_fasta().
 
     Returns
     -------
@@ -110,13 +388,16 @@ def read_flu_data(fn, fmt='fasta'):
             # the header specified as:
             # Isolate ID|Isolate name|Lineage|Collection date
             seq_ls = []
-            for record in SeqIO.parse(fn, fmt):
-                header_ls = record.id.split("|")
-                row = header_ls + [str(record.seq)]
+            for header, seq in _iter_fasta_records(fn, backend):
+                # SeqIO's record.id: the header up to the first whitespace
+                record_id = header.split(None, 1)[0] if header.strip() else ""
+                header_ls = record_id.split("|")
+                row = header_ls + [seq]
                 seq_ls.append(row)
 
             seq_df = pd.DataFrame(data=seq_ls, columns=
             ['Isolate_Id','Isolate_Name','Lineage','Collection_date','seq'])
+            return seq_df
         elif fmt == 'txt':
             print('This is code to read .txt files')
         elif fmt == 'genbank':
@@ -144,6 +425,9 @@ def update_main(input_dict, conn):
     Returns
     -------
     Updates master.db
+
+    This commits after every row, so use bulk_insert() to load more than a
+    handful of rows.
     """
     c = conn.cursor()
     fieldnames = list(input_dict.keys())
@@ -157,7 +441,132 @@ def update_main(input_dict, conn):
     conn.commit()
 
 
-def pivot_raw_tbl(df):
+def bulk_insert(conn, rows, table='MAIN', columns=None, batch_size=10000, fast_pragmas=False,
+                defer_indexes=True):
+    """DB IO: loads many rows into a table (by convention, 'main'; see
+    update_main()). The INSERT statement is prepared once and run with
+    executemany() over batches of rows, with one transaction per batch.
+
+    Params
+    ------
+    conn: sqlite3.connect() object.
+    rows: a pandas dataframe, or an iterable of dicts with keys = columns.
+    table: str; table to insert into.
+    columns: list of str; columns to fill. Default = the dataframe's columns,
+        or the keys of the first dict, in which case a later dict with other
+        keys raises a ValueError. If columns is given, keys not in it are
+        ignored. Missing keys/NaN are inserted as NULL.
+    batch_size: int; no. of rows per executemany() call, and per transaction
+        if no indexes are deferred.
+    fast_pragmas: boolean; switch the db to WAL journaling, with
+        synchronous=NORMAL for the duration of the load. Off by default,
+        since WAL mode persists after the load.
+    defer_indexes: boolean; drop the table's indexes before the load and
+        recreate them afterwards, which is much faster than updating them
+        row by row. UNIQUE indexes are kept, so that they still enforce their
+        constraints.
+
+    Returns
+    -------
+    n: int; no. of rows inserted. If indexes are deferred, the whole load
+        (index drops and rebuilds included) is one transaction, so if any of
+        it fails, nothing is loaded and the indexes are left as they were.
+        Otherwise each batch is committed, and the batches before a failing
+        one stay committed.
+    """
+    if isinstance(rows, pd.DataFrame):
+        if columns is None:
+            columns = list(rows.columns)
+        df = rows[columns].astype(object)
+        # NaN -> NULL, and numpy scalars -> python scalars, which sqlite3 can bind
+        row_iter = df.where(df.notna(), None).itertuples(index=False, name=None)
+    else:
+        row_iter = iter(rows)
+        first = next(row_iter, None)
+        if first is None:
+            return 0
+        if columns is None:
+            columns = list(first.keys())
+            row_iter = _check_row_keys(itertools.chain([first], row_iter), set(columns))
+        else:
+            row_iter = itertools.chain([first], row_iter)
+        row_iter = (tuple(_sql_value(row.get(col)) for col in columns) for row in row_iter)
+
+    insert_cmd = "INSERT INTO %s(%s) VALUES (%s)" % (_quote_ident(table),
+                                                     ', '.join(_quote_ident(col) for col in columns),
+                                                     ', '.join(['?']*len(columns)))
+    c = conn.cursor()
+    if fast_pragmas:
+        conn.commit()
+        old_sync = c.execute("PRAGMA synchronous").fetchone()[0]
+        c.execute("PRAGMA journal_mode=WAL")
+        c.execute("PRAGMA synchronous=NORMAL")
+    index_sqls = []
+    if defer_indexes:
+        index_sqls = c.execute("SELECT name, sql FROM sqlite_master WHERE type='index' "
+                               "AND tbl_name=? COLLATE NOCASE AND sql IS NOT NULL", (table,)).fetchall()
+        # UNIQUE indexes enforce constraints, so they stay in place
+        index_sqls = [(name, sql) for name, sql in index_sqls
+                      if sql.split(None, 2)[1].upper() != "UNIQUE"]
+
+    n = 0
+    try:
+        if len(index_sqls) > 0:
+            # one transaction for the whole load, so that a failed insert or
+            # index rebuild rolls back to the table as it was
+            conn.commit()
+            c.execute("BEGIN")
+            for name, _ in index_sqls:
+                c.execute("DROP INDEX %s" % _quote_ident(name))
+        while True:
+            batch = list(itertools.islice(row_iter, batch_size))
+            if len(batch) == 0:
+                break
+            c.executemany(insert_cmd, batch)
+            if len(index_sqls) == 0:
+                conn.commit()
+            n += len(batch)
+        for _, sql in index_sqls:
+            c.execute(sql)
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        if fast_pragmas:
+            c.execute("PRAGMA synchronous=%d" % old_sync)
+
+    return n
+
+
+def _quote_ident(name):
+    """Quotes a table/column/index name as an SQL identifier."""
+    return '"%s"' % name.replace('"', '""')
+
+
+def _check_row_keys(row_iter, col_set):
+    """Passes rows through, raising a ValueError on any row with keys that
+    aren't in col_set, which bulk_insert() would otherwise drop.
+    """
+    for row in row_iter:
+        if not row.keys() <= col_set:
+            raise ValueError("Row has keys %s that are not in the first row; pass columns= "
+                             "to bulk_insert() to load them" % sorted(row.keys() - col_set))
+        yield row
+
+
+def _sql_value(value):
+    """Converts numpy scalars to python scalars, and NaN to None, so that
+    sqlite3 binds them as numbers/NULL rather than as raw bytes.
+    """
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and value != value:
+        return None
+    return value
+
+
+def pivot_raw_tbl(df, packed=False):
     """Pivots a GISAID dataframe of raw data such that each segment is its own column. That is, turns this:
 
     name_id      | segment | seq
@@ -176,9 +585,17 @@ def pivot_raw_tbl(df):
     necessary as some isolate names can have multiple IDs for some reason (but, thankfully, not the other way
     round.)
 
+    Repeated (name_id, segment, seq) rows are dropped by comparing hashes of the
+    sequences rather than the sequences themselves, and the segment columns are
+    filled by placing each sequence directly at its (name_id, segment) codes.
+    As with df.pivot(), two different sequences for the same name_id and
+    segment raise a ValueError.
+
     Params
     ------
     df: a pandas dataframe. Must have the 'name_id' and 'segment' columns.
+    packed: boolean; return the segment columns as packed_seq.PackedSeqArray
+        columns instead of object columns of str.
 
     Returns
     -------
@@ -186,23 +603,49 @@ def pivot_raw_tbl(df):
     """
 
     #d0a: the partition that will remain unpivoted. d0b: the partition to be pivoted.
-    dfa_selection = []; dfb_selection = []
+    dfa_selection = []
     # select the columns for the partition that will remain unpivoted
     for col in df.columns.values:
         if col not in ['segment', 'seq', 'segment_number']:
             dfa_selection.append(col)
-
     dfa = df[dfa_selection].drop_duplicates()
-    dfb = df[['name_id', 'segment', 'seq']].drop_duplicates()
-    dfb_T = dfb.pivot(index='name_id', columns='segment', values='seq')
-    dfb_T.columns.name=None
-    dfb_T.reset_index(inplace=True)
 
-    df = pd.merge(dfa, dfb_T, on='name_id')
+    name_codes, name_uniques = pd.factorize(df['name_id'], use_na_sentinel=False)
+    seg_codes, seg_uniques = pd.factorize(df['segment'], sort=True, use_na_sentinel=False)
+    seqs = df['seq'].to_numpy(dtype=object)
+
+    # only rows sharing a (name_id, segment) cell need their sequences
+    # compared: keep one row per distinct sequence hash, and a cell that is
+    # still repeated after that has conflicting sequences
+    cell = name_codes.astype(np.int64) * len(seg_uniques) + seg_codes
+    repeated = np.bincount(cell, minlength=len(name_uniques) * len(seg_uniques))[cell] > 1
+    rep_rows = np.flatnonzero(repeated)
+    rep_cell = cell[rep_rows]
+    rep_hash = pd.util.hash_array(seqs[rep_rows], categorize=False)
+    order = np.lexsort((rep_hash, rep_cell))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = ((rep_cell[order][1:] != rep_cell[order][:-1])
+                 | (rep_hash[order][1:] != rep_hash[order][:-1]))
+    rep_keep = rep_rows[order[first]]
+    if len(np.unique(cell[rep_keep])) < len(rep_keep):
+        raise ValueError("Index contains duplicate entries, cannot reshape")
+    keep = np.concatenate([np.flatnonzero(~repeated), rep_keep])
+
+    seg_arr = np.full((len(name_uniques), len(seg_uniques)), np.nan, dtype=object)
+    seg_arr[name_codes[keep], seg_codes[keep]] = seqs[keep]
+
+    # one output row per distinct metadata row, as in a merge on name_id
+    row_codes = pd.Index(name_uniques).get_indexer(dfa['name_id'])
+    df = dfa.reset_index(drop=True)
+    if packed:
+        from packed_seq import PackedSeqArray
+    for j, segment in enumerate(seg_uniques):
+        col = seg_arr[row_codes, j]
+        df[segment] = PackedSeqArray.from_strings(col) if packed else col
     return df
 
 
-def get_meta_from_csv(path_meta, d0, meta_cols=["location"], verbose=True):
+def get_meta_from_csv(path_meta, d0, meta_cols=["location"], how='outer', cache=False, verbose=True):
     """Retrieves metadata from a given csv.
     IMPT: the input df must have name_id as a unique identifier!
     e.g. say d0 =
@@ -225,47 +668,35 @@ def get_meta_from_csv(path_meta, d0, meta_cols=["location"], verbose=True):
         elizabeth    | aggt... | ggtc... | aatc...| US/Iowa
         jones        | agct... | ggtc... | agtc...| *
 
+    Only the key columns and meta_cols are read from the csv (with pyarrow's
+    csv engine, if installed).
+
     PARAMS
     ------
     path_meta: str; path to meta.csv
     d0: input dataframe which needs to have metadata columns added
-    meta_cols: columns from meta.csv which you wish to add to d0
+    meta_cols: columns from meta.csv which you wish to add to d0, by their
+        names after renaming (see _META_RENAME), e.g. 'location', 'cdate', or
+        by their original names.
+    how: str; type of merge, as in pd.merge().
+    cache: boolean; keep the metadata in memory, and in an on-disk cache
+        (see cached_read_csv()), so that repeated joins against the same csv
+        skip reading it. Both are refreshed if the csv changes.
+    verbose: boolean; verbosity.
 
     RETURNS
     -------
     d0: the input column, plus the additional requested columns.
     """
-
-    if verbose:
-        print("WARNING: only tested for extracting only the 'location' column!")
-
     try:
-        with open(path_meta) as f:
-            # Extract metadata from csv
-            d0_meta = pd.read_csv(path_meta)
-            if verbose:
-                print("Meta file located.")
-
-            # Rename certain key columns
-            d0_meta.rename(columns={"Isolate_Name":"iso_name",
-                                    "Isolate_Id": "iso_id",
-                                    "Collection_Date":"cdate",
-                                    "Location":"location"},
-                           inplace=True)
-
-            # Create a name_id column in d0_meta
-            name_id_ls = []
-            for index, row in d0_meta.iterrows():
-                 name_id_ls.append(row['iso_name'] + '|' + row['iso_id'])
-            d0_meta['name_id'] = name_id_ls
-
-            # Select just the columns required, and the key to merge on
-            d0_meta = d0_meta[['name_id', 'location']]
-
-            d0 = pd.merge(d0, d0_meta, how='outer', on='name_id')
-            f.close()
+        d0_meta = _read_meta_csv(path_meta, meta_cols, cache=cache)
+        if verbose:
+            print("Meta file located.")
     except IOError:
         print("%s Metadata file not found!" % path_meta)
+        return d0
+
+    d0 = pd.merge(d0, d0_meta, how=how, on='name_id')
 
     if verbose:
         meta_nid = set(d0_meta['name_id']) # n_uq nids in metadata
@@ -277,19 +708,395 @@ def get_meta_from_csv(path_meta, d0, meta_cols=["location"], verbose=True):
     return d0
 
 
-def get_seqs_from_fasta(df):
+def _read_meta_csv(path_meta, meta_cols, cache=False):
+    """Reads the name_id key and meta_cols out of a GISAID metadata csv, for
+    get_meta_from_csv(). The columns are renamed as per _META_RENAME.
+    """
+    st = os.stat(path_meta)
+    cache_key = (os.path.abspath(path_meta), tuple(meta_cols))
+    if cache:
+        cached = _META_CACHE.get(cache_key)
+        if cached is not None and cached[0] == (st.st_size, st.st_mtime_ns):
+            return cached[1].copy()
+
+    # read the header first, to only parse the columns needed
+    raw_cols = list(pd.read_csv(path_meta, nrows=0).columns)
+    raw_names = {_META_RENAME.get(col, col): col for col in raw_cols}
+    missing = [col for col in ["iso_name", "iso_id"] + list(meta_cols)
+               if col not in raw_names and col not in raw_cols]
+    if len(missing) > 0:
+        raise ValueError("Columns %s not in %s, which has columns %s" % (missing, path_meta, raw_cols))
+    key_cols = [raw_names["iso_name"], raw_names["iso_id"]]
+    usecols = list(dict.fromkeys(key_cols + [raw_names.get(col, col) for col in meta_cols]))
+
+    kwargs = {"usecols": usecols, "dtype": {col: str for col in key_cols}}
+    if pa is not None:
+        kwargs["engine"] = "pyarrow"
+    if cache:
+        d0_meta = cached_read_csv(path_meta, **kwargs)
+    else:
+        d0_meta = pd.read_csv(path_meta, **kwargs)
+
+    # Rename certain key columns, and create a name_id column
+    d0_meta = d0_meta.rename(columns=_META_RENAME)
+    d0_meta['name_id'] = d0_meta['iso_name'] + '|' + d0_meta['iso_id']
+    d0_meta = d0_meta[['name_id'] + [_META_RENAME.get(col, col) for col in meta_cols]]
+
+    if cache:
+        _META_CACHE[cache_key] = ((st.st_size, st.st_mtime_ns), d0_meta.copy())
+    return d0_meta
+
+
+def get_seqs_from_fasta(df, fn, key_col='name_id', key_fields=(1, 0), sep="|",
+                        seq_col='seq', verbose=True):
     """A related operation to get_meta_from_csv(): this time, we add (or override)
     a sequence column to a metadata df, instead of adding metadata columns to
     a seq data df.
+
+    Sequences are looked up through the fasta's offset index (see
+    build_fasta_index()), so only the requested records are read from disk.
+    e.g. for a GISAID fasta with headers 'Isolate ID|Isolate name|...', the
+    name_id 'iso_name|iso_id' is built from header fields (1, 0).
+
+    Params
+    ------
+    df: input dataframe, with a column of keys to look up.
+    fn: str; path to the fasta.
+    key_col: str; column of df holding the keys.
+    key_fields: tuple of int; which '|'-delimited header fields, joined by
+        '|', make up the key.
+    sep: str; header field delimiter.
+    seq_col: str; name of the sequence column to add/override.
+    verbose: boolean; verbosity.
+
+    Returns
+    -------
+    df: the input df, with seq_col added. Keys not found in the fasta get NaN.
     """
-    return "WIP"
+    index = load_fasta_index(fn, key_fields=key_fields, sep=sep)
+    seq_ls = []
+    n_found = 0
+    if len(index["keys"]) == 0 or index["stat"][0] == 0:
+        # nothing to look up, and an empty file can't be mmap'd
+        seq_ls = [np.nan] * df.shape[0]
+    else:
+        with open(fn, 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for key in df[key_col]:
+                    i = index["keys"].get(key)
+                    if i is None:
+                        seq_ls.append(np.nan)
+                    else:
+                        seq_ls.append(_read_indexed_seq(mm, index, i))
+                        n_found += 1
+    df[seq_col] = seq_ls
+
+    if verbose:
+        print("Found %s of %s keys in %s" % (n_found, df.shape[0], fn))
+
+    return df
+
+
+def fetch_seq(fn, key, key_fields=(0,), sep="|"):
+    """Returns the sequence of a single record, looked up by key through the
+    fasta's offset index, without parsing the rest of the file.
+
+    Params
+    ------
+    fn: str; path to the fasta.
+    key: str; e.g. an Isolate_Id with the default key_fields=(0,).
+    key_fields, sep: see get_seqs_from_fasta().
+
+    Returns
+    -------
+    seq: str, or None if key is not in the fasta.
+    """
+    index = load_fasta_index(fn, key_fields=key_fields, sep=sep)
+    i = index["keys"].get(key)
+    if i is None or index["stat"][0] == 0:
+        return None
+    with open(fn, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return _read_indexed_seq(mm, index, i)
+
+
+def build_fasta_index(fn, idx_fn=None):
+    """Builds an offset index for a fasta (similar to samtools' .fai) and saves
+    it as a sidecar .npz next to the fasta. For every record, the index holds
+    the raw header, the byte offset of its sequence, and the sequence's
+    length in bytes (including newlines). The size and mtime of the fasta
+    are saved too, so that stale indexes can be detected.
+
+    Params
+    ------
+    fn: str; path to the fasta.
+    idx_fn: str; path to the index. Default = fn + '.cbi.npz'.
+
+    Returns
+    -------
+    idx: dict of np.arrays, with keys 'headers', 'offsets', 'lengths',
+        'src_size', 'src_mtime'.
+    """
+    if idx_fn is None:
+        idx_fn = fn + ".cbi.npz"
+
+    st = os.stat(fn)
+    headers = []; offsets = []; lengths = []
+    if st.st_size > 0:
+        with open(fn, 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for hdr_start, seq_start, rec_end in _scan_fasta(mm):
+                    headers.append(mm[hdr_start:seq_start].rstrip())
+                    offsets.append(seq_start)
+                    lengths.append(rec_end - seq_start)
+
+    idx = {"headers": np.array(headers, dtype=bytes),
+           "offsets": np.array(offsets, dtype=np.int64),
+           "lengths": np.array(lengths, dtype=np.int64),
+           "src_size": np.int64(st.st_size),
+           "src_mtime": np.int64(st.st_mtime_ns)}
+    try:
+        with open(idx_fn, 'wb') as f:
+            np.savez(f, **idx)
+    except IOError:
+        print("Could not write fasta index %s; keeping it in memory only." % idx_fn)
+
+    return idx
+
+
+def load_fasta_index(fn, key_fields=(0,), sep="|", idx_fn=None):
+    """Loads the offset index of a fasta, (re)building it if the sidecar is
+    missing, or if the fasta's size or mtime has changed since it was built.
+    Loaded indexes are cached for the rest of the session.
+
+    Params
+    ------
+    fn: str; path to the fasta.
+    key_fields: tuple of int; which header fields make up the lookup key.
+    sep: str; header field delimiter.
+    idx_fn: str; path to the index. Default = fn + '.cbi.npz'.
+
+    Returns
+    -------
+    index: dict with 'keys' (a dict of key -> record no., where the first
+        record wins for duplicate keys), 'offsets' and 'lengths'.
+    """
+    if idx_fn is None:
+        idx_fn = fn + ".cbi.npz"
+    st = os.stat(fn)
+    cache_key = (os.path.abspath(fn), tuple(key_fields), sep)
+    cached = _FASTA_INDEX_CACHE.get(cache_key)
+    if cached is not None and cached["stat"] == (st.st_size, st.st_mtime_ns):
+        return cached
+
+    idx = None
+    if os.path.isfile(idx_fn):
+        with np.load(idx_fn, allow_pickle=False) as npz:
+            if (int(npz["src_size"]) == st.st_size
+                    and int(npz["src_mtime"]) == st.st_mtime_ns):
+                idx = {k: npz[k] for k in npz.files}
+    if idx is None:
+        idx = build_fasta_index(fn, idx_fn=idx_fn)
+
+    keys = {}
+    for i, header in enumerate(idx["headers"]):
+        fields = [field.strip() for field in header.decode().split(sep)]
+        key = "|".join(fields[j] if j < len(fields) else "" for j in key_fields)
+        keys.setdefault(key, i)
+
+    index = {"keys": keys,
+             "offsets": idx["offsets"],
+             "lengths": idx["lengths"],
+             "stat": (st.st_size, st.st_mtime_ns)}
+    _FASTA_INDEX_CACHE[cache_key] = index
+    return index
+
+
+def _read_indexed_seq(mm, index, i):
+    """Reads record i's sequence out of a mmap'd fasta, given its index."""
+    start = int(index["offsets"][i])
+    end = start + int(index["lengths"][i])
+    return mm[start:end].translate(None, b"\r\n \t").decode().strip()
+
+
+def _scan_fasta(mm):
+    """Yields (hdr_start, seq_start, rec_end) byte offsets for every record
+    in a mmap'd fasta. hdr_start points just past the '>', seq_start just
+    past the header's newline, and rec_end at the '>' of the next record (or
+    the end of the file). Anything before the first '>' is ignored.
+    """
+    size = len(mm)
+    if mm[:1] == b">":
+        start = 0
+    else:
+        start = mm.find(b"\n>")
+        start = -1 if start == -1 else start + 1
+
+    while start != -1:
+        nxt = mm.find(b"\n>", start)
+        rec_end = size if nxt == -1 else nxt + 1
+        nl = mm.find(b"\n", start, rec_end)
+        seq_start = rec_end if nl == -1 else nl + 1
+        yield start + 1, seq_start, rec_end
+        start = -1 if nxt == -1 else nxt + 1
+
+
+def cached_read_fasta(fn, cols=None, backend='native', cache_dir=None, rebuild=False):
+    """Like read_fasta(), but returns a dataframe (header columns as in
+    iter_fasta_chunks(), plus 'seq'), and caches it on disk so that later
+    calls skip parsing altogether. See _read_cached() for how the cache works.
+
+    Params
+    ------
+    fn: str; path to the fasta.
+    cols: list of str; header column names. See iter_fasta_chunks().
+    backend: str; 'native' or 'seqio'. See iter_fasta().
+    cache_dir: str; where to keep the cache. Default = next to fn.
+    rebuild: boolean; ignore any existing cache.
+
+    Returns
+    -------
+    df: pandas dataframe.
+    """
+    def parse():
+        rows = read_fasta(fn, backend=backend)
+        if len(rows) == 0:
+            return pd.DataFrame(columns=list(cols or []) + ["seq"])
+        return pd.DataFrame(_rows_to_columns(rows, cols))
+
+    options = {"reader": "fasta", "cols": cols, "backend": backend}
+    return _read_cached(fn, options, parse, cache_dir=cache_dir, rebuild=rebuild)
+
+
+def cached_read_flu_data(fn, backend='native', cache_dir=None, rebuild=False):
+    """Cached read_flu_data() for GISAID fastas. See cached_read_fasta()."""
+    options = {"reader": "flu_data", "backend": backend}
+    return _read_cached(fn, options, lambda: read_flu_data(fn, fmt='fasta', backend=backend),
+                        cache_dir=cache_dir, rebuild=rebuild)
+
+
+def cached_read_csv(fn, cache_dir=None, rebuild=False, **kwargs):
+    """Cached pd.read_csv(fn, **kwargs), e.g. for GISAID metadata csvs.
+    kwargs are part of the cache key, so different usecols/dtypes get
+    separate caches. See cached_read_fasta().
+    """
+    options = {"reader": "csv", "kwargs": kwargs}
+    return _read_cached(fn, options, lambda: pd.read_csv(fn, **kwargs),
+                        cache_dir=cache_dir, rebuild=rebuild)
+
+
+def _read_cached(fn, options, parse, cache_dir=None, rebuild=False):
+    """Returns the dataframe parse() makes out of fn, through an on-disk
+    cache. The cache file is named after fn and a hash of the parser options,
+    and holds the size and mtime of fn when it was built (like the fasta
+    index, see build_fasta_index()), so it is rebuilt whenever fn changes.
+
+    Caches are Parquet files, read memory-mapped, if pyarrow is installed,
+    and .npz files otherwise, holding each string column as one utf-8
+    buffer plus an offsets array.
+    """
+    st = os.stat(fn)
+    opt_hash = hashlib.sha1(repr(sorted(options.items())).encode()).hexdigest()[:12]
+    if cache_dir is None:
+        cache_dir = os.path.dirname(os.path.abspath(fn))
+    cache_fn = os.path.join(cache_dir, "%s.cbc-%s.%s" % (os.path.basename(fn), opt_hash,
+                                                        "npz" if pa is None else "parquet"))
+    src_stat = (st.st_size, st.st_mtime_ns)
+
+    if not rebuild and os.path.isfile(cache_fn):
+        try:
+            df = _load_frame_cache(cache_fn, src_stat)
+        except Exception as e:
+            print("Could not read cache %s (%s); rebuilding it." % (cache_fn, e))
+            df = None
+        if df is not None:
+            return df
+
+    df = parse()
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        _save_frame_cache(df, cache_fn, src_stat)
+    except Exception as e:
+        # e.g. a read-only dir, or columns pyarrow can't convert
+        print("Could not write cache %s (%s); continuing without it." % (cache_fn, e))
+    return df
+
+
+def _save_frame_cache(df, cache_fn, src_stat):
+    """Writes df to a Parquet or .npz cache file. See _read_cached(). The
+    cache is written to a temp file first and then moved into place, so an
+    interrupted write never leaves a truncated cache behind.
+    """
+    fd, tmp_fn = tempfile.mkstemp(dir=os.path.dirname(cache_fn),
+                                  prefix=os.path.basename(cache_fn) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            _write_frame_cache(df, f, src_stat)
+        os.replace(tmp_fn, cache_fn)
+    except BaseException:
+        os.remove(tmp_fn)
+        raise
+
+
+def _write_frame_cache(df, f, src_stat):
+    """Writes df to an open file in the cache format. See _save_frame_cache()."""
+    src_meta = {"src_size": np.int64(src_stat[0]), "src_mtime": np.int64(src_stat[1])}
+    if pa is not None:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        table = table.replace_schema_metadata(dict(table.schema.metadata or {},
+                                                   **{k: str(v) for k, v in src_meta.items()}))
+        pq.write_table(table, f)
+        return
+
+    arrs = dict(src_meta, columns=np.array([str(col) for col in df.columns], dtype=str))
+    for i, col in enumerate(df.columns):
+        values = df[col].to_numpy()
+        if values.dtype == object:
+            na = pd.isna(values)
+            str_ls = ["" if is_na else str(v) for v, is_na in zip(values, na)]
+            offsets = np.zeros(len(str_ls) + 1, dtype=np.int64)
+            offsets[1:] = np.cumsum([len(v) for v in str_ls])
+            arrs["buf%d" % i] = np.frombuffer("".join(str_ls).encode('utf-8'), dtype=np.uint8)
+            arrs["offsets%d" % i] = offsets
+            arrs["na%d" % i] = na
+        else:
+            arrs["values%d" % i] = values
+    np.savez(f, **arrs)
+
+
+def _load_frame_cache(cache_fn, src_stat):
+    """Reads a cache file written by _save_frame_cache(), or returns None if
+    it was built from a different version of the source file.
+    """
+    if pa is not None:
+        table = pq.read_table(cache_fn, memory_map=True)
+        meta = table.schema.metadata or {}
+        if (int(meta.get(b"src_size", -1)), int(meta.get(b"src_mtime", -1))) != src_stat:
+            return None
+        return table.to_pandas()
+
+    with np.load(cache_fn, allow_pickle=False) as npz:
+        if (int(npz["src_size"]), int(npz["src_mtime"])) != src_stat:
+            return None
+        data = {}
+        for i, col in enumerate(npz["columns"].tolist()):
+            if "values%d" % i in npz.files:
+                data[col] = npz["values%d" % i]
+                continue
+            text = npz["buf%d" % i].tobytes().decode('utf-8')
+            offsets = npz["offsets%d" % i].tolist()
+            col_arr = np.empty(len(offsets) - 1, dtype=object)
+            col_arr[:] = [text[a:b] for a, b in zip(offsets[:-1], offsets[1:])]
+            col_arr[npz["na%d" % i]] = np.nan
+            data[col] = col_arr
+    return pd.DataFrame(data, columns=list(data.keys()))
 
 
 def location_split(loc_ls, max_loc_len=5, verbose=False):
     """Splits a list of locations, where each location is in the format:
     'continent/country/state/city/district', into an array of 5. Location
     entries with less than 5 elements are padded with a '*' to represent empty
-    values.
+    values. Each distinct location is only split once.
 
     Params
     ------
@@ -300,48 +1107,162 @@ def location_split(loc_ls, max_loc_len=5, verbose=False):
     -------
     loc_arr: str array, shape (n_locations, 5).
     """
+    codes, _, uq_arr = _split_unique_locations(loc_ls, max_loc_len)
+    loc_arr = uq_arr[codes]
 
-    loc_arr = []
+    if verbose:
+        for ln in loc_arr[:5]:
+            print(ln.tolist())
 
-    counter = 0
-    for line in loc_ls:
-        ln = line.split("/")
-        for i in range(len(ln)):
-            ln[i] = ln[i].strip()
-        # Pad ln with '*'
-        ln = ln + ["*"]*(max_loc_len-len(ln))
+    return loc_arr
 
-        if verbose:
-            if counter < 5:
-                print(ln)
-                counter +=1
-        loc_arr.append(ln)
 
-    return np.array(loc_arr)
+def _split_unique_locations(loc_ls, max_loc_len=5):
+    """Factorizes a list of locations and splits each distinct location into
+    its levels, with whitespace stripped and '*' padding. Missing locations
+    get '*' for every level.
+
+    Returns
+    -------
+    codes: int array; the index of each location in the uniques.
+    uq_locs: object array; the distinct locations, re-joined without the
+        whitespace around '/'s.
+    uq_arr: str array, shape (n_uniques, max_loc_len).
+    """
+    codes, uniques = pd.factorize(np.asarray(loc_ls, dtype=object), use_na_sentinel=False)
+    uq_locs = np.empty(len(uniques), dtype=object)
+    uq_rows = []
+    for i, loc in enumerate(uniques):
+        if not isinstance(loc, str):
+            uq_locs[i] = loc
+            uq_rows.append(["*"]*max_loc_len)
+            continue
+        ln = [level.strip() for level in loc.split("/")]
+        if len(ln) > max_loc_len:
+            raise ValueError("Location '%s' has more than %s levels" % (loc, max_loc_len))
+        uq_locs[i] = "/".join(ln)
+        # Pad ln with '*'
+        uq_rows.append(ln + ["*"]*(max_loc_len-len(ln)))
+    uq_arr = np.array(uq_rows, dtype=str).reshape(len(uq_rows), max_loc_len)
+    return codes, uq_locs, uq_arr
 
 
 def adjust_raw_loc(df):
     """Wrapper for location_split(). Formats the existing 'location' column,
-    and adds the location array as 5 new columns.
-    """
-    loc_ls = list(df.location)
-    for i in range(len(loc_ls)):
-        loca = loc_ls[i].split("/")
-        loca = [i.strip() for i in loca]
-        loca = "/".join(loca)
-        loc_ls[i] = loca
-    df["location"] = loc_ls
-
-    loc_arr = location_split(loc_ls)
-    df["continent"] = loc_arr[:, 0]
-    df["country"] = loc_arr[:, 1]
-    df["state"] = loc_arr[:, 2]
-    df["city"] = loc_arr[:, 3]
-    df["district"] = loc_arr[:, 4]
+    and adds the location array as 5 new categorical columns. Each distinct
+    location is parsed once, and the level columns are built by remapping
+    the location codes, so the cost scales with the no. of distinct locations.
+    """
+    codes, uq_locs, uq_arr = _split_unique_locations(df["location"])
+    df["location"] = uq_locs[codes]
+
+    for j, level in enumerate(["continent", "country", "state", "city", "district"]):
+        level_codes, categories = pd.factorize(uq_arr[:, j])
+        df[level] = pd.Categorical.from_codes(level_codes[codes], categories=categories)
 
     return df
 
 
+def load_region_index(fn=None, aliases=None):
+    """Builds a country -> region lookup from a dict of region -> list of
+    countries, such as cc_dict.json. Countries are keyed by their normalized
+    names (see _normalize_country()), so 'Hong Kong (Sar)' and 'hong kong sar'
+    are the same key. The index is cached for the rest of the session, and
+    rebuilt if the json changes.
+
+    Params
+    ------
+    fn: str; path to the json. Default = cc_dict.json next to this file.
+    aliases: dict of {other spelling: country in the json}, on top of
+        _COUNTRY_ALIASES.
+
+    Returns
+    -------
+    index: dict of {normalized country: region}.
+    """
+    if fn is None:
+        fn = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cc_dict.json")
+    all_aliases = dict(_COUNTRY_ALIASES, **(aliases or {}))
+    st = os.stat(fn)
+    cache_key = (os.path.abspath(fn), tuple(sorted(all_aliases.items())))
+    cached = _REGION_INDEX_CACHE.get(cache_key)
+    if cached is not None and cached[0] == (st.st_size, st.st_mtime_ns):
+        return cached[1]
+
+    with open(fn) as f:
+        cc_dict = json.load(f)
+    index = {}
+    for region, countries in cc_dict.items():
+        for country in countries:
+            index[_normalize_country(country)] = region
+    for alias, country in all_aliases.items():
+        region = index.get(_normalize_country(country))
+        if region is not None:
+            index.setdefault(_normalize_country(alias), region)
+
+    _REGION_INDEX_CACHE[cache_key] = ((st.st_size, st.st_mtime_ns), index)
+    return index
+
+
+def country_to_region(countries, fn=None, aliases=None):
+    """Maps a column of country names to regions. Each distinct country is
+    looked up once, and the regions are built by remapping its codes.
+    Missing countries (NaN, or '*' from adjust_raw_loc()) get NaN.
+
+    Params
+    ------
+    countries: list-like or categorical of str, e.g. df['country'].
+    fn, aliases: see load_region_index().
+
+    Returns
+    -------
+    regions: categorical pd.Series, with the same index as countries if it is
+        a Series.
+    unmatched: list of the distinct countries with no region.
+    """
+    index = load_region_index(fn, aliases=aliases)
+    countries = pd.Series(countries)
+    if isinstance(countries.dtype, pd.CategoricalDtype):
+        codes = countries.cat.codes.to_numpy()
+        uniques = countries.cat.categories
+    else:
+        codes, uniques = pd.factorize(countries.to_numpy(dtype=object))
+
+    uq_regions = []; unmatched = []
+    for country in uniques:
+        if not isinstance(country, str) or country.strip() in ("", "*"):
+            uq_regions.append(None)
+            continue
+        region = index.get(_normalize_country(country))
+        if region is None:
+            unmatched.append(country)
+        uq_regions.append(region)
+
+    region_codes, categories = pd.factorize(np.array(uq_regions, dtype=object))
+    region_codes = np.append(region_codes, -1)  # so that code -1 (NaN) stays NaN
+    regions = pd.Series(pd.Categorical.from_codes(region_codes[codes], categories=categories),
+                        index=countries.index)
+    return regions, unmatched
+
+
+def add_region(df, country_col='country', region_col='region', fn=None, aliases=None, verbose=True):
+    """Wrapper for country_to_region(). Adds a region column to df, e.g.
+    after adjust_raw_loc(), and reports the countries with no region.
+    """
+    df[region_col], unmatched = country_to_region(df[country_col], fn=fn, aliases=aliases)
+    if verbose and len(unmatched) > 0:
+        print("WARNING: no region for %s countries: %s" % (len(unmatched), unmatched))
+    return df
+
+
+def _normalize_country(name):
+    """Lowercases a country name, and reduces punctuation and '_' to single
+    spaces, e.g. "Lao, People'S Democratic Republic" -> 'lao people s
+    democratic republic'.
+    """
+    return " ".join(re.sub(r"[\W_]+", " ", name.casefold().replace("&", " and ")).split())
+
+
 def xls_to_csv(fn):
     fn_out = fn[:-4] + ".csv"
     wb = xlrd.open_workbook(fn)
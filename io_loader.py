@@ -0,0 +1,32 @@
+"""Loader for this repo's io.py, which shares its name with the stdlib io
+module (always imported first), so it can't be reached with a plain import.
+
+Usage:
+>>> from io_loader import load_cb_io
+>>> cb_io = load_cb_io()
+>>> for row in cb_io.iter_fasta("gisaid_HA.fasta"):
+...     print(row[0])
+"""
+
+import os
+import sys
+import importlib.util
+
+
+def load_cb_io():
+    """Loads io.py from its path as the module 'cb_io'. The module is cached
+    in sys.modules, so every caller gets the same module object, and shares
+    its caches (e.g. the fasta index and metadata caches).
+    """
+    if "cb_io" in sys.modules:
+        return sys.modules["cb_io"]
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "io.py")
+    spec = importlib.util.spec_from_file_location("cb_io", path)
+    cb_io = importlib.util.module_from_spec(spec)
+    sys.modules["cb_io"] = cb_io
+    try:
+        spec.loader.exec_module(cb_io)
+    except BaseException:
+        del sys.modules["cb_io"]
+        raise
+    return cb_io
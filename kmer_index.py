@@ -0,0 +1,216 @@
+"""Library for finding the closest reference sequences to a query, using an
+index of packed k-mers, so that the expensive alignment functions only need
+to be run on a shortlist of candidates.
+"""
+
+import numpy as np
+import pandas as pd
+
+from io_loader import load_cb_io
+
+cb_io = load_cb_io()
+
+
+# 2-bit codes for A, C, G, T (U = T); 255 for anything else.
+_BASE_CODES = np.full(256, 255, dtype=np.uint8)
+for _i, _chars in enumerate(["Aa", "Cc", "Gg", "TtUu"]):
+    for _ch in _chars:
+        _BASE_CODES[ord(_ch)] = _i
+
+
+def kmer_codes(seq, k=15):
+    """Packs every k-mer of seq into a uint64, 2 bits per base, so k <= 32.
+    k-mers containing anything other than A, C, G, T/U (e.g. gaps, N) are
+    skipped. Case-insensitive.
+
+    Params
+    ------
+    seq: str.
+    k: int; k-mer length.
+
+    Returns
+    -------
+    kmers: uint64 array of the distinct k-mers in seq, sorted.
+    """
+    if k > 32:
+        raise ValueError("k must be <= 32 to pack k-mers into 64 bits")
+    codes = _BASE_CODES[np.frombuffer(seq.encode('latin-1'), dtype=np.uint8)]
+    n_kmers = len(codes) - k + 1
+    if n_kmers <= 0:
+        return np.zeros(0, dtype=np.uint64)
+
+    # a k-mer is valid if there is no invalid base in its window
+    n_invalid = np.concatenate([[0], np.cumsum(codes == 255)])
+    valid = (n_invalid[k:] - n_invalid[:-k]) == 0
+
+    packed = np.zeros(n_kmers, dtype=np.uint64)
+    codes = codes.astype(np.uint64)
+    for t in range(k):
+        packed = (packed << np.uint64(2)) | codes[t:t + n_kmers]
+    return np.unique(packed[valid])
+
+
+def _sample_kmers(kmers, scaled):
+    """Keeps the k-mers whose hash is divisible by scaled (FracMinHash), so
+    that queries and references are sketched consistently.
+    """
+    if scaled <= 1:
+        return kmers
+    hashed = kmers * np.uint64(0x9E3779B97F4A7C15)
+    hashed ^= hashed >> np.uint64(31)
+    return kmers[hashed % np.uint64(scaled) == 0]
+
+
+def build_kmer_index(records, k=15, scaled=1, keep_seqs=True):
+    """Builds an inverted k-mer index over a panel of reference sequences:
+    a sorted array of every (k-mer, reference) pair, so that the references
+    sharing a k-mer with a query are found by binary search.
+
+    Params
+    ------
+    records: iterable of (name, seq) pairs, e.g.
+        ((row[0], row[-1]) for row in iter_fasta(fn)).
+    k: int; k-mer length, <= 32.
+    scaled: int; if > 1, only ~1/scaled of the k-mers are indexed
+    (FracMinHash), to shrink the index for large panels.
+    keep_seqs: boolean; store the reference sequences in the index too, so
+    that query_kmer_index() can re-score candidates.
+
+    Returns
+    -------
+    index: dict of np.arrays; see save_kmer_index().
+    """
+    names = []
+    kmer_ls = []
+    seqs = []
+    for name, seq in records:
+        names.append(name)
+        kmer_ls.append(_sample_kmers(kmer_codes(seq, k), scaled))
+        if keep_seqs:
+            seqs.append(seq)
+
+    n_kmers = np.array([len(km) for km in kmer_ls], dtype=np.int64)
+    kmers = np.concatenate(kmer_ls) if len(kmer_ls) > 0 else np.zeros(0, dtype=np.uint64)
+    ref_ids = np.repeat(np.arange(len(names), dtype=np.int32), n_kmers)
+    order = np.argsort(kmers, kind='stable')
+
+    index = {"kmers": kmers[order],
+             "ref_ids": ref_ids[order],
+             "names": np.array(names, dtype=str),
+             "n_kmers": n_kmers,
+             "k": np.int64(k),
+             "scaled": np.int64(scaled)}
+    if keep_seqs:
+        index["seq_buf"], index["seq_offsets"] = _pack_strings(seqs)
+    return index
+
+
+def build_kmer_index_from_fasta(fn, idx_fn=None, k=15, scaled=1, name_field=0, keep_seqs=True,
+                                backend='native'):
+    """Builds a k-mer index over the records of a reference fasta, naming
+    each reference by the '|'-delimited field name_field of its header, and
+    saves it to idx_fn if given. The fasta is streamed with io.iter_fasta().
+    """
+    records = ((row[name_field], row[-1]) for row in cb_io.iter_fasta(fn, backend=backend))
+    index = build_kmer_index(records, k=k, scaled=scaled, keep_seqs=keep_seqs)
+    if idx_fn is not None:
+        save_kmer_index(index, idx_fn)
+    return index
+
+
+def save_kmer_index(index, fn):
+    """Saves a k-mer index as a .npz of plain NumPy arrays: 'kmers' (sorted
+    uint64 k-mers), 'ref_ids' (the reference of each k-mer), 'names',
+    'n_kmers' (no. of k-mers per reference), 'k', 'scaled', and optionally
+    'seq_buf'/'seq_offsets' (the concatenated reference sequences).
+    """
+    with open(fn, 'wb') as f:
+        np.savez(f, **index)
+
+
+def load_kmer_index(fn):
+    """Loads a k-mer index saved by save_kmer_index()."""
+    with np.load(fn, allow_pickle=False) as npz:
+        return {key: npz[key] for key in npz.files}
+
+
+def query_kmer_index(index, queries, top_k=5, rescore=None, higher_is_better=True):
+    """Finds the top_k references sharing the most k-mers with each query,
+    and optionally re-scores only that shortlist with an alignment function.
+
+    Params
+    ------
+    index: dict, from build_kmer_index() or load_kmer_index().
+    queries: list of (name, seq) pairs, or list of str.
+    top_k: int; max. no. of candidate references per query. Only
+    references sharing at least one k-mer with the query are candidates, so
+    a query can get fewer (or no) hits.
+    rescore: optional callable(query_seq, ref_seq) -> score, e.g.
+    string_utils.NW_score, or string_utils.string_similarity for hamming
+    distance. Needs an index built with keep_seqs=True.
+    higher_is_better: boolean; how to rank the rescore results (False for
+    distances).
+
+    Returns
+    -------
+    hits: dataframe with columns query, rank, ref, shared_kmers and
+    containment (the fraction of the query's k-mers found in the reference),
+    plus score if rescore is given. Ranked by score if rescored, by shared
+    k-mers otherwise.
+    """
+    k = int(index["k"]); scaled = int(index["scaled"])
+    kmers = index["kmers"]; ref_ids = index["ref_ids"]
+    names = index["names"]
+    n_refs = len(names)
+    if rescore is not None and "seq_buf" not in index:
+        raise ValueError("rescore needs an index built with keep_seqs=True")
+
+    rows = []
+    for qi, query in enumerate(queries):
+        q_name, q_seq = query if isinstance(query, tuple) else (qi, query)
+        q_kmers = _sample_kmers(kmer_codes(q_seq, k), scaled)
+
+        # all the (k-mer, ref) entries matching the query's k-mers
+        lo = np.searchsorted(kmers, q_kmers, side='left')
+        hi = np.searchsorted(kmers, q_kmers, side='right')
+        lens = hi - lo
+        hit_idx = np.repeat(lo - np.cumsum(lens) + lens, lens) + np.arange(lens.sum())
+        shared = np.bincount(ref_ids[hit_idx], minlength=n_refs)
+
+        # references sharing no k-mers at all are never candidates
+        candidates = np.flatnonzero(shared > 0)
+        n_top = min(top_k, len(candidates))
+        if n_top < len(candidates):
+            candidates = candidates[np.argpartition(-shared[candidates], n_top - 1)[:n_top]]
+        top = candidates[np.argsort(-shared[candidates], kind='stable')]
+
+        hits = []
+        for r in top:
+            hit = {"query": q_name, "ref": names[r], "shared_kmers": int(shared[r]),
+                   "containment": shared[r] / len(q_kmers) if len(q_kmers) > 0 else np.nan}
+            if rescore is not None:
+                hit["score"] = rescore(q_seq, _unpack_string(index["seq_buf"], index["seq_offsets"], r))
+            hits.append(hit)
+        if rescore is not None:
+            hits.sort(key=lambda hit: hit["score"], reverse=higher_is_better)
+        for rank, hit in enumerate(hits):
+            hit["rank"] = rank
+            rows.append(hit)
+
+    cols = ["query", "rank", "ref", "shared_kmers", "containment"]
+    if rescore is not None:
+        cols.append("score")
+    return pd.DataFrame(rows, columns=cols)
+
+
+def _pack_strings(str_ls):
+    """Concatenates strings into one uint8 buffer plus an offsets array."""
+    offsets = np.zeros(len(str_ls) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(s) for s in str_ls])
+    buf = np.frombuffer("".join(str_ls).encode('latin-1'), dtype=np.uint8)
+    return buf, offsets
+
+
+def _unpack_string(buf, offsets, i):
+    """The i-th string of a buffer from _pack_strings()."""
+    return buf[offsets[i]:offsets[i+1]].tobytes().decode('latin-1')
@@ -5,17 +5,33 @@ MSA screener prints out a whole bunch of sequence information for you, by readin
 input fasta file!
 
 Usage:
-$ python3 msa_screener.py input_fasta.fas 0.8
+$ python3 msa_screener.py input_fasta.fas --min_len 0.8
+(or, as before, $ python3 msa_screener.py input_fasta.fas 0.8)
+
+For alignments too big to fit in memory, --stream screens the file in a single
+pass, keeping only the (name, length, QC metrics) of each sequence:
+$ python3 msa_screener.py input_fasta.fas --min_len 0.8 --stream
+
+Many files (or globs) can be screened at once, in parallel, with results
+written as a table for further processing:
+$ python3 msa_screener.py "batch_01/*.fas" --jobs 8 --format tsv --short_out short.tsv
 
 Don Teng, 24 May 2017
 """
 
+import os
 import sys
+import glob
+import json
 import pandas as pd
 import numpy as np
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 
-from Bio import SeqIO
+from string_utils import seq_metrics, hist_median
+from io_loader import load_cb_io
+
+cb_io = load_cb_io()
 
 
 """ ============== DEFS ============== """
@@ -34,91 +50,294 @@ def replace_chars(char_ls, new_char, my_string):
     return my_string
 
 
-def read_fasta(fn, verbose=False):
-    """Reads a fasta into a list of lists, where each list is one record.
+def screen_df(fn, min_len=0.8, char_ls=["-", "n"]):
+    """Screens a fasta by reading it into a dataframe first.
 
-    Params
-    ------
-    fn: string; filename
-    verbose: boolean; verbosity.
+    Returns
+    -------
+    summary: dict of summary statistics; see print_report().
+    d_p: dataframe of short seqs, with columns iso_name, len, % of median len.
+    """
+    # Read fasta into a dataframe
+    contents = cb_io.read_fasta(fn)
+    if len(contents) == 0:
+        return _empty_screen(min_len)
+    fasta_cols = []
+    # Doesn't matter what the fasta header comprises
+    # only that the last column is named "seq"
+    for i in range(1,len(contents[0])-1):
+        fasta_cols.append("col"+str(i))
+    fasta_cols = ["iso_name"] + fasta_cols + ["seq"]
+
+    df = pd.DataFrame(data=contents, columns=fasta_cols)
+
+    # MSA screen
+    metrics = seq_metrics(list(df["seq"]), char_ls=char_ls)
+    seq_len_ls = metrics["len"].values
+    medi = np.median(seq_len_ls)
+    summary = {"n_seqs": df.shape[0],
+               "mean_len": np.average(seq_len_ls),
+               "median_len": medi,
+               "min_len": min_len,
+               "min_len_required": int(medi*min_len),
+               "mean_gap_frac": metrics["gap_frac"].mean(),
+               "mean_ambig_frac": metrics["ambig_frac"].mean(),
+               "mean_gc": metrics["gc"].mean()}
+
+    is_short = seq_len_ls < int(medi*min_len)
+    d_p = pd.DataFrame({"iso_name": df["iso_name"].values[is_short],
+                        "len": seq_len_ls[is_short],
+                        "% of median len": seq_len_ls[is_short]/medi})
+    return summary, d_p
+
+
+def screen_stream(fn, min_len=0.8, char_ls=["-", "n"], chunk_size=10000):
+    """Screens a fasta in a single streaming pass, so that memory is bounded
+    by the no. of records rather than the size of the sequences. Sequences
+    are read and measured chunk_size at a time, and then discarded; only the
+    name and ungapped length of each sequence are retained. The median is
+    computed exactly from a histogram of the lengths.
+
+    Returns the same (summary, d_p) as screen_df().
+    """
+    names = []
+    len_chunks = []
+    len_hist = np.zeros(0, dtype=np.int64)
+    sums = {"gap_frac": [0.0, 0], "ambig_frac": [0.0, 0], "gc": [0.0, 0]}
+
+    def consume(seq_chunk):
+        metrics = seq_metrics(seq_chunk, char_ls=char_ls)
+        lens = metrics["len"].values
+        len_chunks.append(lens.astype(np.int32))
+        for col in sums:
+            sums[col][0] += metrics[col].sum()
+            sums[col][1] += metrics[col].count()
+        return np.bincount(lens)
+
+    seq_chunk = []
+    for row in cb_io.iter_fasta(fn):
+        names.append(row[0])
+        seq_chunk.append(row[-1])
+        if len(seq_chunk) == chunk_size:
+            len_hist = _add_hist(len_hist, consume(seq_chunk))
+            seq_chunk = []
+    if len(seq_chunk) > 0:
+        len_hist = _add_hist(len_hist, consume(seq_chunk))
+
+    if len(names) == 0:
+        return _empty_screen(min_len)
+    seq_len_ls = np.concatenate(len_chunks)
+    medi = hist_median(len_hist)
+    summary = {"n_seqs": len(names),
+               "mean_len": np.average(seq_len_ls),
+               "median_len": medi,
+               "min_len": min_len,
+               "min_len_required": int(medi*min_len),
+               "mean_gap_frac": sums["gap_frac"][0]/sums["gap_frac"][1] if sums["gap_frac"][1] else np.nan,
+               "mean_ambig_frac": sums["ambig_frac"][0]/sums["ambig_frac"][1] if sums["ambig_frac"][1] else np.nan,
+               "mean_gc": sums["gc"][0]/sums["gc"][1] if sums["gc"][1] else np.nan}
+
+    # second, lightweight pass over the retained (name, length) pairs only
+    is_short = np.flatnonzero(seq_len_ls < int(medi*min_len))
+    d_p = pd.DataFrame({"iso_name": [names[i] for i in is_short],
+                        "len": seq_len_ls[is_short].astype(np.int64),
+                        "% of median len": seq_len_ls[is_short]/medi})
+    return summary, d_p
+
+
+def _empty_screen(min_len):
+    """The (summary, d_p) of a fasta with no records: n_seqs = 0, and NaN for
+    every statistic.
+    """
+    summary = {"n_seqs": 0,
+               "mean_len": np.nan,
+               "median_len": np.nan,
+               "min_len": min_len,
+               "min_len_required": np.nan,
+               "mean_gap_frac": np.nan,
+               "mean_ambig_frac": np.nan,
+               "mean_gc": np.nan}
+    d_p = pd.DataFrame(columns=["iso_name", "len", "% of median len"])
+    return summary, d_p
+
+
+def _add_hist(h1, h2):
+    """Adds two histograms (bincounts) of possibly different lengths."""
+    if len(h1) < len(h2):
+        h1, h2 = h2, h1
+    h1 = h1.copy()
+    h1[:len(h2)] += h2
+    return h1
+
+
+def print_report(summary, d_p, file=sys.stdout):
+    """Prints the screening results of screen_df() or screen_stream() to file."""
+    print(""" \n============== MSA screener ============== """, file=file)
+    print("no. of sequences = %s" % summary["n_seqs"], file=file)
+    print("Average seq len = %.3f" % summary["mean_len"], file=file)
+    print("Median seq len = %s" % summary["median_len"], file=file)
+    print("Minimum seq len required = %s" % summary["min_len_required"], file=file)
+    print("Min seq len calculated as %s * median seq length" % summary["min_len"], file=file)
+    print("Average gap fraction = %.3f" % summary["mean_gap_frac"], file=file)
+    print("Average ambiguous base fraction = %.3f" % summary["mean_ambig_frac"], file=file)
+    print("Average GC content = %.3f" % summary["mean_gc"], file=file)
+    print("", file=file)
+
+    if d_p.shape[0] > 0:
+        print("Short seqs (< min length required)", file=file)
+        print(d_p, file=file)
+
+    print(""" \n============== End of output ============== """, file=file)
+
+
+def screen_file(fn, min_len=0.8, char_ls=["-", "n"], stream=False):
+    """Screens one file with screen_stream() or screen_df(). Errors are
+    caught and returned, so that one bad file doesn't stop a whole batch.
+
+    Returns
+    -------
+    fn: str; the input file.
+    summary: dict; see print_report(). Has an 'error' key if screening failed.
+    d_p: dataframe of short seqs.
+    """
+    try:
+        if stream:
+            summary, d_p = screen_stream(fn, min_len=min_len, char_ls=char_ls)
+        else:
+            summary, d_p = screen_df(fn, min_len=min_len, char_ls=char_ls)
+    except Exception as e:
+        summary = {"error": "%s: %s" % (type(e).__name__, e)}
+        d_p = pd.DataFrame(columns=["iso_name", "len", "% of median len"])
+    return fn, summary, d_p
+
+
+def split_min_len(inputs, min_len=None, default=0.8):
+    """Separates the old positional min_len ('msa_screener.py input.fas 0.8')
+    from the inputs: a trailing argument that parses as a number, and isn't an
+    existing file, is taken as min_len.
 
     Returns
     -------
-    contents: a list of lists.
+    inputs: list of str; the input files/patterns.
+    min_len: float.
     """
-    print_limit = 0
-    contents = []
-    for record in SeqIO.parse(fn, "fasta"):
-        header = record.description
-        seq = str(record.seq)
-        row = header.split("|") + [seq]
-        contents.append(row)
-        if verbose:
-            if print_limit < 5:
-                preview_seq = row[-1][:10] + "..."
-                print_row = row[:-1] + [preview_seq]
-                print(print_row)
-                print_limit +=1
-
-    # strip whitespaces, which GISAID tends to add
-    for i in range(len(contents)):
-        for j in range(len(contents[i])):
-            contents[i][j] = contents[i][j].strip()
-
-    return contents
+    inputs = list(inputs)
+    if len(inputs) > 1 and not os.path.exists(inputs[-1]):
+        try:
+            pos_min_len = float(inputs[-1])
+        except ValueError:
+            pos_min_len = None
+        if pos_min_len is not None:
+            if min_len is not None:
+                raise ValueError("min_len given both as --min_len and as a trailing '%s'" % inputs[-1])
+            inputs = inputs[:-1]
+            min_len = pos_min_len
+    return inputs, (default if min_len is None else min_len)
+
+
+def expand_inputs(patterns):
+    """Expands glob patterns into a sorted, de-duplicated list of files.
+    Patterns without any match are kept as is, so that they are reported as
+    missing rather than silently skipped.
+    """
+    fns = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+        for fn in (matches if len(matches) > 0 else [pattern]):
+            if fn not in fns:
+                fns.append(fn)
+    return fns
+
+
+def write_results(results, fmt="text", short_out=None, out=sys.stdout):
+    """Writes the screening results of many files.
+
+    Params
+    ------
+    results: list of (fn, summary, d_p), from screen_file().
+    fmt: 'text' (one print_report() per file), 'tsv' (one summary row per
+    file) or 'json' (one object per file, including its short seqs).
+    short_out: str; if given, the short seqs of all files are written to this
+    path as a single TSV, with a 'file' column.
+    out: file handle for the main output.
+    """
+    if fmt == "text":
+        for fn, summary, d_p in results:
+            print("\n%s" % fn, file=out)
+            if "error" in summary:
+                print("ERROR: %s" % summary["error"], file=out)
+            else:
+                print_report(summary, d_p, file=out)
+    elif fmt == "tsv":
+        rows = [dict(file=fn, n_short=d_p.shape[0], **summary) for fn, summary, d_p in results]
+        pd.DataFrame(rows).to_csv(out, sep="\t", index=False)
+    elif fmt == "json":
+        objs = []
+        for fn, summary, d_p in results:
+            obj = {"file": fn}
+            obj.update({k: _json_value(v) for k, v in summary.items()})
+            obj["short_seqs"] = [{k: _json_value(v) for k, v in rec.items()}
+                                 for rec in d_p.to_dict(orient="records")]
+            objs.append(obj)
+        json.dump(objs, out, indent=2, allow_nan=False)
+        out.write("\n")
+
+    if short_out is not None:
+        d_all = [d_p.assign(file=fn) for fn, summary, d_p in results]
+        d_all = pd.concat(d_all, ignore_index=True) if len(d_all) > 0 else pd.DataFrame()
+        d_all.to_csv(short_out, sep="\t", index=False)
+
+
+def _json_value(v):
+    """Converts a numpy scalar to its Python equivalent, and NaN/inf to None,
+    which strict JSON has no literal for.
+    """
+    if isinstance(v, np.generic):
+        v = v.item()
+    if isinstance(v, float) and not np.isfinite(v):
+        return None
+    return v
 
 
 """ ============== ARGPARSE ============== """
 
+parser = argparse.ArgumentParser(description="Screens fasta MSAs for problematic sequences.")
+parser.add_argument("inputs", nargs="+",
+                    help="input fasta files, or glob patterns (quote them to bypass the shell)")
+parser.add_argument("--min_len", type=float, default=None,
+                    help="min. length required, as a fraction of the median length (default 0.8). "
+                         "For backwards compatibility, it can also be given as a trailing number "
+                         "after the inputs, e.g. 'input_fasta.fas 0.8'")
+parser.add_argument("--chars", default="-n",
+                    help="characters ignored when computing lengths (default '-n')")
+parser.add_argument("--stream", action="store_true",
+                    help="screen in a single streaming pass, without loading each file into memory")
+parser.add_argument("--jobs", type=int, default=1,
+                    help="no. of files to screen concurrently (default 1)")
+parser.add_argument("--format", choices=["text", "tsv", "json"], default="text",
+                    help="output format (default text)")
+parser.add_argument("--short_out", default=None,
+                    help="also write the short seqs of all files to this TSV")
+
+
 """ ============== PROC ============== """
-fn = sys.argv[1]
-char_ls = ["-", "n"]
-min_len=0.8
-
-# Read fasta into a dataframe
-contents = read_fasta(fn)
-fasta_cols = []
-# Doesn't matter what the fasta header comprises
-# only that the last column is named "seq"
-for i in range(1,len(contents[0])-1):
-    fasta_cols.append("col"+str(i))
-fasta_cols = ["iso_name"] + fasta_cols + ["seq"]
-
-df = pd.DataFrame(data=contents, columns=fasta_cols)
-
-
-# MSA screen
-# replace gapped length
-seq_ls = list(df["seq"])
-seq_len_ls = []
-for i in range(len(seq_ls)):
-    seq_ls[i] = replace_chars(char_ls, "", seq_ls[i])
-    seq_len_ls.append(len(seq_ls[i]))
-
-seq_len_ls = np.array(seq_len_ls)
-df["ungapped_seq"] = seq_ls
-medi = np.median(seq_len_ls)
-
-print(""" \n============== MSA screener ============== """)
-print("no. of sequences = %s" % df.shape[0])
-print("Average seq len = %.3f" % np.average(seq_len_ls))
-print("Median seq len = %s" % medi)
-print("Minimum seq len required = %s" % int(medi*min_len))
-print("Min seq len calculated as %s * median seq length" % min_len)
-print("")
-
-d_p_contents = []
-for index, row in df.iterrows():
-    if len(row["ungapped_seq"]) < int(medi*min_len):
-        d_p_contents.append([row["iso_name"],
-        len(row["ungapped_seq"]),
-        len(row["ungapped_seq"])/medi])
-
-d_p = pd.DataFrame(data=d_p_contents, columns=["iso_name",
-"len",
-"% of median len"])
-if d_p.shape[0] > 0:
-    print("Short seqs (< min length required)")
-    print(d_p)
-
-print(""" \n============== End of output ============== """)
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    try:
+        inputs, min_len = split_min_len(args.inputs, args.min_len)
+    except ValueError as e:
+        parser.error(str(e))
+    char_ls = list(args.chars)
+    fns = expand_inputs(inputs)
+    screen_args = [(fn, min_len, char_ls, args.stream) for fn in fns]
+
+    if args.jobs > 1 and len(fns) > 1:
+        with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+            results = list(pool.map(screen_file, *zip(*screen_args)))
+    else:
+        results = [screen_file(*a) for a in screen_args]
+
+    write_results(results, fmt=args.format, short_out=args.short_out)
+    if any("error" in summary for fn, summary, d_p in results):
+        sys.exit(1)
@@ -0,0 +1,397 @@
+"""Compact storage for nucleotide sequences: 4 bits per base in one contiguous
+NumPy buffer with an offsets array, wrapped as a pandas ExtensionArray so it
+can be used as a dataframe column in place of an object column of str.
+
+Bases are packed as nibbles over the alphabet "-ACGTRYSWKMBDHVN" (gap, the
+four bases, and the IUPAC ambiguity codes), which covers all but a few
+characters of a typical flu alignment. Case is kept as one flag per sequence,
+and anything else (other characters, or letters whose case differs from the
+rest of their sequence) goes into a small exceptions list, so that unpacking
+always gives back the original string.
+
+Usage:
+>>> df['seq'] = PackedSeqArray.from_strings(df['seq'])
+>>> df['seq'].astype('packed_seq')   # same thing
+"""
+
+import numbers
+
+import numpy as np
+import pandas as pd
+from pandas.api.extensions import ExtensionArray, ExtensionDtype, register_extension_dtype
+
+
+NIBBLE_ALPHABET = "-ACGTRYSWKMBDHVN"
+
+# char (either case) -> nibble, 255 for chars outside the alphabet
+_NIBBLE_CODES = np.full(256, 255, dtype=np.uint8)
+for _i, _ch in enumerate(NIBBLE_ALPHABET):
+    _NIBBLE_CODES[ord(_ch)] = _i
+    _NIBBLE_CODES[ord(_ch.lower())] = _i
+_ALPHABET_BYTES = (NIBBLE_ALPHABET + NIBBLE_ALPHABET.lower()).encode('ascii')
+_NIBBLE_CHARS = np.frombuffer(NIBBLE_ALPHABET.encode('ascii'), dtype=np.uint8)
+_NIBBLE_CHARS_LOWER = np.frombuffer(NIBBLE_ALPHABET.lower().encode('ascii'), dtype=np.uint8)
+_N_CODE = NIBBLE_ALPHABET.index("N")
+
+
+@register_extension_dtype
+class PackedSeqDtype(ExtensionDtype):
+    """pandas dtype for PackedSeqArray; the string alias is 'packed_seq'."""
+    name = "packed_seq"
+    type = str
+    kind = "O"
+    na_value = np.nan
+
+    @classmethod
+    def construct_array_type(cls):
+        return PackedSeqArray
+
+
+class PackedSeqArray(ExtensionArray):
+    """An immutable array of sequences packed 2 bases per byte.
+
+    Each sequence starts on a byte boundary, so sequence i is the bytes
+    buf[offsets[i]:offsets[i+1]], and equality, hashing and factorizing
+    compare these packed bytes (as uint64 words, see key_words()) with NumPy
+    rather than the unpacked strings.
+
+    Attributes
+    ----------
+    buf: uint8 array of packed nibbles, high nibble first.
+    offsets: int64 array of len n+1; byte offsets of each sequence in buf.
+    lens: int64 array; no. of bases in each sequence.
+    lower: boolean array; True if the sequence is (mostly) lowercase.
+    na: boolean array; True for missing values.
+    exc_offsets, exc_pos, exc_char: the exceptions, as a CSR list: sequence
+    i's exceptions are at positions exc_pos[exc_offsets[i]:exc_offsets[i+1]]
+    with characters exc_char[...]. Characters outside the alphabet are
+    stored as 'N' in buf.
+    """
+
+    def __init__(self, buf, offsets, lens, lower, na, exc_offsets, exc_pos, exc_char):
+        self.buf = buf
+        self.offsets = offsets
+        self.lens = lens
+        self.lower = lower
+        self.na = na
+        self.exc_offsets = exc_offsets
+        self.exc_pos = exc_pos
+        self.exc_char = exc_char
+
+    @classmethod
+    def from_strings(cls, seq_ls):
+        """Packs a list-like of str (None/NaN for missing values)."""
+        seq_ls = list(seq_ls)
+        n = len(seq_ls)
+        na = np.zeros(n, dtype=bool)
+        lens = np.zeros(n, dtype=np.int64)
+        lower = np.zeros(n, dtype=bool)
+        parts = []
+        exc_seqs = []
+        for i, seq in enumerate(seq_ls):
+            if not isinstance(seq, str):
+                na[i] = True
+                continue
+            raw = seq.encode('latin-1')
+            lens[i] = len(raw)
+            # most sequences are all one case and only use the alphabet
+            if raw.islower():
+                lower[i] = True
+            elif not raw.isupper():
+                # mixed case, or no letters at all
+                exc_seqs.append(i)
+            if raw.translate(None, _ALPHABET_BYTES):
+                exc_seqs.append(i)
+            # pad odd lengths so that every sequence starts on a byte boundary
+            parts.append(raw + b"-" if len(raw) % 2 else raw)
+
+        codes = _NIBBLE_CODES[np.frombuffer(b"".join(parts), dtype=np.uint8)]
+        codes[codes == 255] = _N_CODE
+        buf = (codes[0::2] << 4) | codes[1::2]
+        offsets = np.zeros(n + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum((lens + 1) // 2)
+
+        # exceptions: chars outside the alphabet, or in the minority case
+        exc_offsets = np.zeros(n + 1, dtype=np.int64)
+        exc_pos_ls = []; exc_char_ls = []
+        for i in sorted(set(exc_seqs)):
+            raw = np.frombuffer(seq_ls[i].encode('latin-1'), dtype=np.uint8)
+            is_upper = (raw >= 65) & (raw <= 90)
+            is_lower = (raw >= 97) & (raw <= 122)
+            lower[i] = is_lower.sum() > is_upper.sum()
+            is_exc = (_NIBBLE_CODES[raw] == 255) | (is_upper if lower[i] else is_lower)
+            pos = np.flatnonzero(is_exc)
+            exc_pos_ls.append(pos)
+            exc_char_ls.append(raw[pos])
+            exc_offsets[i+1] = len(pos)
+        exc_offsets = np.cumsum(exc_offsets)
+        exc_pos = np.concatenate(exc_pos_ls).astype(np.int64) if exc_pos_ls else np.zeros(0, dtype=np.int64)
+        exc_char = np.concatenate(exc_char_ls) if exc_char_ls else np.zeros(0, dtype=np.uint8)
+        return cls(buf, offsets, lens, lower, na, exc_offsets, exc_pos, exc_char)
+
+    # ---------- ExtensionArray interface ----------
+
+    @classmethod
+    def _from_sequence(cls, scalars, *, dtype=None, copy=False):
+        if isinstance(scalars, cls):
+            return scalars.copy() if copy else scalars
+        return cls.from_strings(scalars)
+
+    @classmethod
+    def _from_sequence_of_strings(cls, strings, *, dtype=None, copy=False):
+        return cls.from_strings(strings)
+
+    @classmethod
+    def _from_factorized(cls, values, original):
+        # values are group ids from _values_for_factorize(); -1 (missing) is
+        # only kept with use_na_sentinel=False
+        values = np.asarray(values, dtype=np.int64)
+        _, first = original._group_ids()
+        first = np.append(first, -1)
+        return original.take(first[values], allow_fill=True)
+
+    @classmethod
+    def _concat_same_type(cls, to_concat):
+        to_concat = list(to_concat)
+
+        def concat_offsets(arrs):
+            shift = np.cumsum([0] + [arr[-1] for arr in arrs[:-1]])
+            return np.concatenate([[0]] + [arr[1:] + s for arr, s in zip(arrs, shift)]).astype(np.int64)
+
+        return cls(np.concatenate([a.buf for a in to_concat]),
+                   concat_offsets([a.offsets for a in to_concat]),
+                   np.concatenate([a.lens for a in to_concat]),
+                   np.concatenate([a.lower for a in to_concat]),
+                   np.concatenate([a.na for a in to_concat]),
+                   concat_offsets([a.exc_offsets for a in to_concat]),
+                   np.concatenate([a.exc_pos for a in to_concat]),
+                   np.concatenate([a.exc_char for a in to_concat]))
+
+    @property
+    def dtype(self):
+        return PackedSeqDtype()
+
+    @property
+    def nbytes(self):
+        return sum(arr.nbytes for arr in (self.buf, self.offsets, self.lens, self.lower, self.na,
+                                           self.exc_offsets, self.exc_pos, self.exc_char))
+
+    def __len__(self):
+        return len(self.lens)
+
+    def __getitem__(self, key):
+        if isinstance(key, numbers.Integral):
+            if key < 0:
+                key += len(self)
+            if not 0 <= key < len(self):
+                raise IndexError("index %s is out of bounds for size %s" % (key, len(self)))
+            return self._unpack(key)
+        if isinstance(key, slice):
+            return self.take(np.arange(len(self))[key])
+        key = pd.api.indexers.check_array_indexer(self, key)
+        if key.dtype == bool:
+            key = np.flatnonzero(key)
+        return self.take(key)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self._unpack(i)
+
+    def __array__(self, dtype=None, copy=None):
+        return self.to_strings() if dtype is None else self.to_strings().astype(dtype)
+
+    def __eq__(self, other):
+        if isinstance(other, (pd.Series, pd.Index, pd.DataFrame)):
+            return NotImplemented
+        if isinstance(other, str):
+            other = PackedSeqArray.from_strings([other])
+        else:
+            if not isinstance(other, PackedSeqArray):
+                other = PackedSeqArray.from_strings(other)
+            if len(other) != len(self):
+                raise ValueError("Lengths must match to compare")
+        # keyed together, so that both sides share one word layout
+        rows = _void_rows(PackedSeqArray._concat_same_type([self, other]).key_words())
+        n = len(self)
+        other_na = other.na if len(other) == n else np.repeat(other.na, n)
+        return (rows[:n] == rows[n:]) & ~self.na & ~other_na
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        return eq if eq is NotImplemented else ~eq
+
+    def isna(self):
+        return self.na.copy()
+
+    def copy(self):
+        return PackedSeqArray(self.buf.copy(), self.offsets.copy(), self.lens.copy(), self.lower.copy(),
+                              self.na.copy(), self.exc_offsets.copy(), self.exc_pos.copy(), self.exc_char.copy())
+
+    def take(self, indices, allow_fill=False, fill_value=None):
+        indices = np.asarray(indices, dtype=np.int64)
+        n = len(self)
+        if allow_fill:
+            if (indices < -1).any():
+                raise ValueError("indices must be >= -1 when allow_fill is True")
+            fill = indices == -1
+            if isinstance(fill_value, str):
+                raise TypeError("only missing values can be used as fill_value")
+        else:
+            indices = np.where(indices < 0, indices + n, indices)
+            fill = np.zeros(len(indices), dtype=bool)
+        if ((indices >= n) | ((indices < 0) & ~fill)).any():
+            raise IndexError("indices are out of bounds for size %s" % n)
+        indices = np.where(fill, 0, indices)
+        if n == 0:
+            indices = indices[:0]
+            fill = fill[:0]
+
+        buf_offsets, buf_idx = _gather_ranges(self.offsets, indices, fill)
+        exc_offsets, exc_idx = _gather_ranges(self.exc_offsets, indices, fill)
+        return PackedSeqArray(self.buf[buf_idx], buf_offsets,
+                              np.where(fill, 0, self.lens[indices]),
+                              self.lower[indices] & ~fill,
+                              self.na[indices] | fill,
+                              exc_offsets, self.exc_pos[exc_idx], self.exc_char[exc_idx])
+
+    def _values_for_factorize(self):
+        return self._group_ids()[0], -1
+
+    def duplicated(self, keep='first'):
+        # missing values all share group id -1, so they are duplicates of
+        # each other, as for other dtypes
+        return pd.Index(self._group_ids()[0]).duplicated(keep=keep)
+
+    def _hash_pandas_object(self, *, encoding, hash_key, categorize):
+        return self.hash_values()
+
+    def _values_for_argsort(self):
+        return self.to_strings()
+
+    # ---------- packed operations ----------
+
+    def key_words(self):
+        """The packed form of every sequence as one row of uint64 words, so
+        that sequences can be compared whole-row with NumPy: [length, no. of
+        exceptions, lowercase flag, packed bytes (zero-padded to whole words),
+        then (position, char) of each exception]. The counts come first, so
+        two rows are equal iff their strings are equal. Rows are zero-padded
+        to the widest one; missing values are all-zero rows, and have to be
+        masked with na.
+
+        Returns
+        -------
+        words: uint64 array, shape (n, 3 + max. words per sequence +
+        2 * max. exceptions per sequence).
+        """
+        n = len(self)
+        n_bytes = np.diff(self.offsets)
+        n_exc = np.diff(self.exc_offsets)
+        max_words = int(((n_bytes + 7) // 8).max(initial=0))
+        max_exc = int(n_exc.max(initial=0))
+
+        words = np.zeros((n, 3 + max_words + 2*max_exc), dtype=np.uint64)
+        words[:, 0] = self.lens
+        words[:, 1] = n_exc
+        words[:, 2] = self.lower
+
+        body = np.zeros((n, 8*max_words), dtype=np.uint8)
+        rows, cols = _csr_coords(self.offsets)
+        body[rows, cols] = self.buf[:self.offsets[-1]]
+        words[:, 3:3 + max_words] = body.view('<u8')
+
+        exc = np.zeros((n, max_exc, 2), dtype=np.uint64)
+        rows, cols = _csr_coords(self.exc_offsets)
+        exc[rows, cols, 0] = self.exc_pos
+        exc[rows, cols, 1] = self.exc_char
+        words[:, 3 + max_words:] = exc.reshape(n, 2*max_exc)
+        words[self.na] = 0
+        return words
+
+    def _group_ids(self):
+        """Numbers the distinct sequences in order of first appearance.
+
+        Returns
+        -------
+        ids: int64 array; the group of each sequence, -1 for missing values.
+        first: int64 array; the index of the first sequence of each group.
+        """
+        ids = np.full(len(self), -1, dtype=np.int64)
+        valid = np.flatnonzero(~self.na)
+        if len(valid) == 0:
+            return ids, np.zeros(0, dtype=np.int64)
+        rows = _void_rows(self.key_words()[valid])
+        _, first, inverse = np.unique(rows, return_index=True, return_inverse=True)
+        order = np.argsort(first)
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.arange(len(order))
+        ids[valid] = rank[inverse.ravel()]
+        return ids, valid[first[order]]
+
+    def hash_values(self):
+        """uint64 hash of each sequence, computed from its packed words.
+        Only each row's own words are mixed in, not the zero padding, so a
+        sequence hashes the same in any array.
+        """
+        words = self.key_words()
+        n_words = (np.diff(self.offsets) + 7) // 8
+        n_exc = np.diff(self.exc_offsets)
+        max_words = words.shape[1] - 3 - 2*int(n_exc.max(initial=0))
+        h = pd.util.hash_array(words[:, 0])
+        for j in range(1, words.shape[1]):
+            if j < 3:
+                used = True
+            elif j < 3 + max_words:
+                used = j - 3 < n_words
+            else:
+                used = j - 3 - max_words < 2*n_exc
+            h = np.where(used, pd.util.hash_array(h ^ words[:, j]), h)
+        # same hash as pandas gives a missing value of other dtypes
+        h[self.na] = pd.util.hash_array(np.array([None], dtype=object))[0]
+        return h
+
+    def to_strings(self):
+        """Unpacks into an object array of str (NaN for missing values)."""
+        out = np.empty(len(self), dtype=object)
+        for i in range(len(self)):
+            out[i] = self._unpack(i)
+        return out
+
+    def _unpack(self, i):
+        if self.na[i]:
+            return self.dtype.na_value
+        packed = self.buf[self.offsets[i]:self.offsets[i+1]]
+        nibbles = np.empty(2 * len(packed), dtype=np.uint8)
+        nibbles[0::2] = packed >> 4
+        nibbles[1::2] = packed & 15
+        chars = (_NIBBLE_CHARS_LOWER if self.lower[i] else _NIBBLE_CHARS)[nibbles[:self.lens[i]]]
+        e0, e1 = self.exc_offsets[i], self.exc_offsets[i+1]
+        if e1 > e0:
+            chars[self.exc_pos[e0:e1]] = self.exc_char[e0:e1]
+        return chars.tobytes().decode('latin-1')
+
+
+def _csr_coords(offsets):
+    """(row, column) of every element of a CSR-style offsets array."""
+    lens = np.diff(offsets)
+    rows = np.repeat(np.arange(len(lens)), lens)
+    return rows, np.arange(offsets[-1]) - np.repeat(offsets[:-1], lens)
+
+
+def _void_rows(words):
+    """Views each row of a 2-D array as one opaque scalar, so that rows can
+    be compared or np.unique'd as a whole.
+    """
+    words = np.ascontiguousarray(words)
+    return words.view(np.dtype((np.void, words.shape[1] * words.itemsize))).ravel()
+
+
+def _gather_ranges(offsets, indices, fill):
+    """For a CSR-style offsets array, the new offsets and the flat index of
+    the elements of ranges indices (empty where fill is True).
+    """
+    lens = np.where(fill, 0, offsets[indices + 1] - offsets[indices])
+    new_offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+    new_offsets[1:] = np.cumsum(lens)
+    idx = np.repeat(offsets[indices] - new_offsets[:-1], lens) + np.arange(new_offsets[-1])
+    return new_offsets, idx
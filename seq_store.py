@@ -0,0 +1,249 @@
+"""Library for keeping GISAID sequences and their metadata in a SQLite db, so
+that subsets (by region, date range, lineage...) can be streamed out without
+reading the whole dataset into pandas.
+
+By convention (see io.update_main()), all records live in the db's 'main'
+table, with one row per isolate and segment. Sequences are stored as
+zlib-compressed BLOBs.
+
+Usage:
+>>> ingest("flu.db", "gisaid_HA.fasta", meta_fn="gisaid_meta.csv", segment="HA")
+>>> for rec in query("flu.db", region="Southeast Asia", date_from="2017-01-01"):
+...     print(rec["name_id"], len(rec["seq"]))
+>>> export_fasta("flu.db", "sea_HA.fasta", region="Southeast Asia", segment="HA")
+"""
+
+import zlib
+import sqlite3
+
+import pandas as pd
+
+from io_loader import load_cb_io
+
+cb_io = load_cb_io()
+
+
+_COLUMNS = ["name_id", "iso_id", "iso_name", "segment", "lineage", "cdate",
+            "location", "country", "region", "seq_len", "seq"]
+
+_SCHEMA = """CREATE TABLE IF NOT EXISTS main (
+    name_id TEXT NOT NULL,
+    iso_id TEXT,
+    iso_name TEXT,
+    segment TEXT,
+    lineage TEXT,
+    cdate TEXT,
+    location TEXT,
+    country TEXT,
+    region TEXT,
+    seq_len INTEGER,
+    seq BLOB)"""
+
+_INDEXES = {"main_name_id": "name_id",
+            "main_segment": "segment",
+            "main_location": "location",
+            "main_cdate": "cdate",
+            "main_region": "region",
+            "main_lineage": "lineage"}
+
+
+def connect(db_fn):
+    """Opens (or creates) a sequence store, making sure the main table and
+    its indexes exist.
+    """
+    conn = sqlite3.connect(db_fn)
+    conn.execute(_SCHEMA)
+    for name, col in _INDEXES.items():
+        conn.execute("CREATE INDEX IF NOT EXISTS %s ON main (%s)" % (name, col))
+    conn.commit()
+    return conn
+
+
+def ingest(db_fn, fasta_fn, meta_fn=None, segment=None,
+           header_cols=("iso_id", "iso_name", "lineage", "cdate"),
+           chunk_size=50000, level=6, backend='native', defer_indexes=None, fast_pragmas=False,
+           verbose=True):
+    """Loads a GISAID fasta, and optionally the location column of its
+    metadata csv, into the store. The fasta is streamed in chunks, so it is
+    never all in memory, and the rows are loaded with io.bulk_insert().
+
+    Params
+    ------
+    db_fn: str; path to the db.
+    fasta_fn: str; path to the fasta.
+    meta_fn: str; path to the GISAID metadata csv. Locations are split into
+        country and region with io.adjust_raw_loc() and io.country_to_region().
+    segment: str; segment of every record in the fasta, e.g. 'HA'. If None,
+        header_cols should have a 'segment' field.
+    header_cols: names of the '|'-delimited header fields. The default is
+        GISAID's 'Isolate ID|Isolate name|Lineage|Collection date'.
+    chunk_size: int; no. of records per chunk.
+    level: int; zlib compression level of the sequences.
+    backend: str; fasta parser, 'native' or 'seqio'. See io.iter_fasta().
+    defer_indexes: boolean; drop the indexes during the load and rebuild them
+        afterwards (see io.bulk_insert()). Default = only if the store is
+        empty, since rebuilding them over a large existing table costs more
+        than updating them.
+    fast_pragmas: boolean; switch the db to WAL journaling for the load (see
+        io.bulk_insert()). WAL mode persists after the load.
+    verbose: boolean; verbosity.
+
+    Returns
+    -------
+    n: int; no. of records loaded.
+    """
+    conn = connect(db_fn)
+    if defer_indexes is None:
+        defer_indexes = conn.execute("SELECT 1 FROM main LIMIT 1").fetchone() is None
+    unmatched = set()
+
+    def iter_rows():
+        for chunk in cb_io.iter_fasta_chunks(fasta_fn, chunk_size=chunk_size, cols=list(header_cols),
+                                             backend=backend):
+            df = pd.DataFrame(chunk)
+            df["name_id"] = df["iso_name"] + "|" + df["iso_id"]
+            if segment is not None:
+                df["segment"] = segment
+            if meta_fn is not None:
+                df = cb_io.get_meta_from_csv(meta_fn, df, meta_cols=["location"], how='left',
+                                             cache=True, verbose=False)
+                has_loc = df["location"].notna()
+                df["country"] = None
+                df["region"] = None
+                if has_loc.any():
+                    locs = cb_io.adjust_raw_loc(df.loc[has_loc, ["location"]].copy())
+                    regions, chunk_unmatched = cb_io.country_to_region(locs["country"])
+                    unmatched.update(chunk_unmatched)
+                    df.loc[has_loc, "location"] = locs["location"]
+                    df.loc[has_loc, "country"] = locs["country"].astype(object)
+                    df.loc[has_loc, "region"] = regions.astype(object)
+            df["seq_len"] = df["seq"].str.len()
+            df["seq"] = [zlib.compress(seq.encode(), level) for seq in df["seq"]]
+            for col in _COLUMNS:
+                if col not in df.columns:
+                    df[col] = None
+            df = df[_COLUMNS].astype(object)
+            yield from df.where(df.notna(), None).to_dict('records')
+
+    try:
+        n = cb_io.bulk_insert(conn, iter_rows(), table='main', columns=_COLUMNS,
+                              fast_pragmas=fast_pragmas, defer_indexes=defer_indexes)
+    finally:
+        conn.close()
+
+    if verbose:
+        print("Loaded %s records from %s into %s" % (n, fasta_fn, db_fn))
+        if len(unmatched) > 0:
+            print("WARNING: no region for %s countries: %s" % (len(unmatched), sorted(unmatched)))
+    return n
+
+
+def query(db, region=None, country=None, segment=None, lineage=None, location=None,
+          name_ids=None, date_from=None, date_to=None, columns=None, batch_size=1000):
+    """Streams the records matching all of the given filters, one dict at a
+    time, with the sequences decompressed. Only batch_size rows are held in
+    memory at a time.
+
+    Params
+    ------
+    db: str (path to the db) or sqlite3 connection.
+    region, country, segment, lineage, location: str or list of str; exact
+        matches.
+    name_ids: list of str.
+    date_from, date_to: str; inclusive bounds on the collection date, as
+        'YYYY-MM-DD' (compared as strings, like GISAID's dates).
+    columns: list of str; columns to return. Default = all.
+    batch_size: int; no. of rows fetched from the db at a time.
+
+    Yields
+    ------
+    rec: dict of {column: value}.
+    """
+    where, params = _where_clause(region=region, country=country, segment=segment,
+                                  lineage=lineage, location=location, name_id=name_ids,
+                                  date_from=date_from, date_to=date_to)
+    columns = list(columns or _COLUMNS)
+    unknown = [col for col in columns if col not in _COLUMNS]
+    if len(unknown) > 0:
+        raise ValueError("Unknown columns: %s" % unknown)
+    sql = "SELECT %s FROM main%s" % (", ".join(columns), where)
+
+    conn = sqlite3.connect(db) if isinstance(db, str) else db
+    try:
+        c = conn.execute(sql, params)
+        while True:
+            batch = c.fetchmany(batch_size)
+            if len(batch) == 0:
+                break
+            for row in batch:
+                rec = dict(zip(columns, row))
+                if rec.get("seq") is not None:
+                    rec["seq"] = zlib.decompress(rec["seq"]).decode()
+                yield rec
+    finally:
+        if isinstance(db, str):
+            conn.close()
+
+
+def query_chunks(db, chunk_size=10000, **filters):
+    """Like query(), but yields dataframes of up to chunk_size records."""
+    recs = []
+    for rec in query(db, **filters):
+        recs.append(rec)
+        if len(recs) == chunk_size:
+            yield pd.DataFrame(recs)
+            recs = []
+    if len(recs) > 0:
+        yield pd.DataFrame(recs)
+
+
+def export_fasta(db, fn, header_cols=("name_id", "cdate", "location"), chunk_size=10000,
+                 line_width=None, compression='infer', **filters):
+    """Streams the records matching filters (see query()) into a fasta, with
+    io.write_fasta().
+
+    Returns
+    -------
+    n: int; no. of records written.
+    """
+    n = 0
+    with cb_io.open_fasta_out(fn, compression) as f:
+        for df in query_chunks(db, chunk_size=chunk_size, **filters):
+            n += cb_io.write_fasta(df, f, list(header_cols), seq_col='seq', line_width=line_width)
+    return n
+
+
+def count(db, **filters):
+    """No. of records matching filters (see query())."""
+    where, params = _where_clause(**filters)
+    conn = sqlite3.connect(db) if isinstance(db, str) else db
+    try:
+        return conn.execute("SELECT COUNT(*) FROM main" + where, params).fetchone()[0]
+    finally:
+        if isinstance(db, str):
+            conn.close()
+
+
+def _where_clause(date_from=None, date_to=None, **filters):
+    """Builds a parameterized WHERE clause out of exact-match filters (a
+    value or list of values per column) and a collection date range.
+    """
+    conds = []; params = []
+    for col, value in filters.items():
+        if value is None:
+            continue
+        if col == "name_ids":
+            col = "name_id"
+        if col not in _COLUMNS:
+            raise ValueError("Unknown filter: %s" % col)
+        values = [value] if isinstance(value, str) else list(value)
+        conds.append("%s IN (%s)" % (col, ", ".join(["?"]*len(values))))
+        params += values
+    if date_from is not None:
+        conds.append("cdate >= ?")
+        params.append(date_from)
+    if date_to is not None:
+        conds.append("cdate <= ?")
+        params.append(date_to)
+    where = " WHERE " + " AND ".join(conds) if len(conds) > 0 else ""
+    return where, params
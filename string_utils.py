@@ -4,12 +4,14 @@
 import os
 import pandas as pd
 import numpy as np
-import itertools
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 
 from Bio import SeqIO
 # from Bio.SeqFeature import SeqFeature, FeatureLocation
 
-def string_similarity(a, b, method='hamming', score_matrix=1, verbose=True):
+def string_similarity(a, b, method='hamming', score_matrix=1, verbose=True,
+                      gap_open=-1, gap_extend=-1):
     """Computes string similarity for two strings, a and b, using some
     similarity method.
 
@@ -17,9 +19,16 @@ def string_similarity(a, b, method='hamming', score_matrix=1, verbose=True):
     ------
     a, b: strings
     method: Various methods for computing string similarity. Available so far:
-    Hamming distance
-    score_matrix: unused param, to be used for edit distance implementations.
+    'hamming': Hamming distance. For strings of unequal length, only the first
+    min(len(a), len(b)) characters are compared.
+    'nw': global alignment score, with a linear gap score of gap_open.
+    'gotoh': global alignment score, with affine gaps (see gotoh_score()).
+    score_matrix: substitution scores for 'nw' and 'gotoh'; a name accepted
+    by score_table() (e.g. 'nuc', 'BLOSUM62'), or a (256, 256) table. The
+    default, 1, is flat scoring: +1 for a match, -1 for a mismatch. Unused
+    for 'hamming'.
     verbose: Tells you what's happening when True.
+    gap_open, gap_extend: gap scores for 'nw' and 'gotoh'.
 
     Return
     ------
@@ -29,64 +38,333 @@ def string_similarity(a, b, method='hamming', score_matrix=1, verbose=True):
         if len(a) != len(b):
             if verbose:
                 print("Note: len(a)!=len(b)")
-            x = min([a, b], key=len)
-            y = max([a, b], key=len)
-        else:
-            x = a; y = b
-        score = 0
-        for i in range(len(x)):
-            if x[i] != y[i]:
-                score +=1
+        n = min(len(a), len(b))
+        x = np.frombuffer(a[:n].encode('latin-1'), dtype=np.uint8)
+        y = np.frombuffer(b[:n].encode('latin-1'), dtype=np.uint8)
+        score = int(np.count_nonzero(x != y))
+    elif method == 'nw':
+        if isinstance(score_matrix, int) and score_matrix == 1:
+            score_matrix = 'flat'
+        score = NW_score(a, b, s=gap_open, score_matrix=score_matrix)
+    elif method == 'gotoh':
+        if isinstance(score_matrix, int) and score_matrix == 1:
+            score_matrix = 'flat'
+        score = gotoh_score(a, b, score_matrix=score_matrix,
+                            gap_open=gap_open, gap_extend=gap_extend)
     return score
 
 
-def self_similarity_matrix(str_ls):
+def encode_seqs(str_ls, pad=0):
+    """Encodes a list of strings, once, into a uint8 array of shape
+    (n_seqs, max_len), for the vectorized distance functions. Strings shorter
+    than max_len are right-padded with pad.
+
+    Params
+    ------
+    str_ls: list of str.
+    pad: int; padding byte. Must not occur in any string.
+
+    Returns
+    -------
+    X: uint8 array, shape (n_seqs, max_len).
+    lens: int64 array, shape (n_seqs,); the length of each string.
+    """
+    n_seq = len(str_ls)
+    lens = np.fromiter((len(seq) for seq in str_ls), dtype=np.int64, count=n_seq)
+    max_len = int(lens.max()) if n_seq > 0 else 0
+
+    if n_seq > 0 and (lens == max_len).all():
+        buf = "".join(str_ls).encode('latin-1')
+        X = np.frombuffer(buf, dtype=np.uint8).reshape(n_seq, max_len).copy()
+    else:
+        X = np.full((n_seq, max_len), pad, dtype=np.uint8)
+        for i in range(n_seq):
+            X[i, :lens[i]] = np.frombuffer(str_ls[i].encode('latin-1'), dtype=np.uint8)
+
+    return X, lens
+
+
+def hamming_matrix(X, lx, Y, ly, block_size=256, pad=0):
+    """Blocked, vectorized hamming distances between every row of X and every
+    row of Y, as encoded by encode_seqs(). Like string_similarity(), pairs of
+    unequal length are only compared over their common prefix.
+
+    Each block of rows is one-hot encoded over the symbols present, so that
+    the no. of matching positions for a whole block of pairs is a single
+    matrix product. Memory use is bounded by block_size.
+
+    Params
+    ------
+    X, Y: uint8 arrays, shape (n1, L1) and (n2, L2).
+    lx, ly: int arrays, shape (n1,) and (n2,); sequence lengths.
+    block_size: int; no. of rows of X (and of Y) processed at a time.
+    pad: int; the padding byte used by encode_seqs().
+
+    Returns
+    -------
+    D: int64 array, shape (n1, n2).
+    """
+    n1 = X.shape[0]; n2 = Y.shape[0]
+    D = np.zeros((n1, n2), dtype=np.int64)
+    if n1 == 0 or n2 == 0:
+        return D
+
+    # compare over the common columns only; anything beyond is padding for
+    # at least one sequence of every pair
+    L = min(X.shape[1], Y.shape[1])
+    X = X[:, :L]; Y = Y[:, :L]
+    present = (np.bincount(X.ravel(), minlength=256) > 0) | (np.bincount(Y.ravel(), minlength=256) > 0)
+    present[pad] = False
+    symbols = np.flatnonzero(present).astype(np.uint8)
+
+    for j0 in range(0, n2, block_size):
+        j1 = min(j0 + block_size, n2)
+        Y_oh = _one_hot(Y[j0:j1], symbols)
+        for i0 in range(0, n1, block_size):
+            i1 = min(i0 + block_size, n1)
+            X_oh = _one_hot(X[i0:i1], symbols)
+            n_match = X_oh @ Y_oh.T
+            n_cmp = np.minimum(lx[i0:i1, None], ly[None, j0:j1])
+            D[i0:i1, j0:j1] = n_cmp - np.rint(n_match).astype(np.int64)
+
+    return D
+
+
+def _one_hot(X, symbols):
+    """One-hot encodes a uint8 block (n, L) over symbols, flattened to shape
+    (n, L*n_symbols) as float32, so that row dot products count matches.
+    """
+    return (X[:, :, None] == symbols).reshape(X.shape[0], -1).astype(np.float32)
+
+
+def self_similarity_matrix(str_ls, condensed=False, block_size=256, n_jobs=1):
     """Returns a similarity matrix of all pairwise distances between all
     possible pairs in str_ls. Only hamming distance implemented so far, so we
     require all elements in str_ls to be of the same length to be comparable.
+
+    Params
+    ------
+    str_ls: list of str.
+    condensed: boolean. If True, returns only the upper triangle as a
+    condensed vector, in the same order as scipy's pdist(), and in the
+    smallest unsigned int dtype that can hold the distances. Use
+    condensed_to_square() or condensed_get() to read it.
+    block_size: int; no. of sequences per block. See hamming_matrix().
+    n_jobs: int; no. of worker processes. -1 uses all cores.
+    See _run_hamming_tiles().
+
+    Returns
+    -------
+    hm_data: float array, shape (n_seq, n_seq), with only the upper triangle
+    filled; or, if condensed, uint array of shape (n_seq*(n_seq-1)/2,).
     """
-    all_pairs = list(itertools.combinations((str_ls), 2))
-    hamming_ls = []
-    n_seq = len(str_ls)
-    for pair in all_pairs:
-        x, y = pair
-        hamming_d = string_similarity(x, y)
-        hamming_ls.append(hamming_d)
+    X, lens = encode_seqs(str_ls)
+    n_seq = X.shape[0]
+    max_d = int(lens.max()) if n_seq > 0 else 0
+
+    # square tiles on or above the diagonal, so that every tile is about the
+    # same amount of work
+    tiles = [(i0, min(i0 + block_size, n_seq), j0, min(j0 + block_size, n_seq))
+             for i0 in range(0, n_seq, block_size)
+             for j0 in range(i0, n_seq, block_size)]
+    d = _run_hamming_tiles(X, lens, None, None, (n_seq*(n_seq-1)//2,), _min_uint_dtype(max_d),
+                           tiles, block_size, n_jobs)
+
+    if condensed:
+        return d
 
     # Construct heatmap data
-    hm_data = np.zeros((n_seq, n_seq))
-    idx = 0
-    for i in range(n_seq):
-        for j in range(i+1, n_seq):
-            hm_data[i][j] = hamming_ls[idx]
-            idx += 1
+    return condensed_to_square(d, n_seq, symmetric=False, dtype=np.float64)
+
+
+def condensed_index(n, i, j):
+    """Index of the pair (i, j), i != j, in a condensed distance vector of n
+    sequences, as returned by self_similarity_matrix(condensed=True).
+    """
+    if i == j:
+        raise ValueError("No condensed entry for the diagonal (i == j == %s)" % i)
+    if i > j:
+        i, j = j, i
+    return n*i - i*(i+1)//2 + (j - i - 1)
+
+
+def condensed_get(d, i, j, n=None):
+    """Looks up the distance between sequences i and j in a condensed
+    distance vector d, without expanding it. Returns 0 for i == j.
+    """
+    if i == j:
+        return 0
+    if n is None:
+        n = _condensed_n(d)
+    return d[condensed_index(n, i, j)]
 
-    return hm_data
 
+def condensed_to_square(d, n=None, symmetric=True, dtype=None):
+    """Expands a condensed distance vector into a square (n, n) matrix.
 
-def similarity_matrix(ls1, ls2, verbose=True):
+    Params
+    ------
+    d: array, shape (n*(n-1)/2,).
+    n: int; no. of sequences. Inferred from len(d) if not given.
+    symmetric: boolean. If False, only the upper triangle is filled, as in
+    the default output of self_similarity_matrix().
+    dtype: output dtype. Defaults to d.dtype.
+
+    Returns
+    -------
+    M: array, shape (n, n).
+    """
+    if n is None:
+        n = _condensed_n(d)
+    M = np.zeros((n, n), dtype=d.dtype if dtype is None else dtype)
+    iu = np.triu_indices(n, k=1)
+    M[iu] = d
+    if symmetric:
+        M[(iu[1], iu[0])] = d
+    return M
+
+
+def _condensed_n(d):
+    """Recovers n from the length of a condensed distance vector."""
+    n = int(round((1 + np.sqrt(1 + 8*len(d)))/2))
+    if n*(n-1)//2 != len(d):
+        raise ValueError("%s is not a valid condensed distance vector length" % len(d))
+    return n
+
+
+def _min_uint_dtype(max_val):
+    """Smallest unsigned int dtype that can hold max_val."""
+    for dt in (np.uint8, np.uint16, np.uint32):
+        if max_val <= np.iinfo(dt).max:
+            return np.dtype(dt)
+    return np.dtype(np.uint64)
+
+
+def similarity_matrix(ls1, ls2, verbose=True, block_size=256, n_jobs=1):
     """Returns a similarity matrix of the hamming distance between all pairs
-    ls1[i] and ls2[j].
+    ls1[i] and ls2[j]. Sequences are encoded once, and distances computed in
+    blocks by hamming_matrix().
 
     Params
     ------
     ls1, ls2: list of strings.
-    verbose: Boolean. Not used within this function;verbosity argument that
-    gets passed to string_similarity().
+    verbose: Boolean. Notes if any pair of strings differ in length, like
+    string_similarity() does.
+    block_size: int; no. of sequences per block. See hamming_matrix().
+    n_jobs: int; no. of worker processes. -1 uses all cores.
+    See _run_hamming_tiles().
 
     Returns
     -------
     M: array of int; shape(len(ls1), len(ls2))
     """
-    n1 = len(ls1); n2 = len(ls2)
-    M = np.zeros((n1, n2))
-    for i in range(n1):
-        for j in range(n2):
-            M[i][j] = string_similarity(ls1[i], ls2[j], verbose=verbose)
-    return M
+    X, lx = encode_seqs(ls1)
+    Y, ly = encode_seqs(ls2)
+    if verbose and len(np.union1d(lx, ly)) > 1:
+        print("Note: len(a)!=len(b)")
+    n1 = X.shape[0]; n2 = Y.shape[0]
+    tiles = [(i0, min(i0 + block_size, n1), j0, min(j0 + block_size, n2))
+             for i0 in range(0, n1, block_size)
+             for j0 in range(0, n2, block_size)]
+    return _run_hamming_tiles(X, lx, Y, ly, (n1, n2), np.float64, tiles, block_size, n_jobs)
+
 
+def _run_hamming_tiles(X, lx, Y, ly, shape, dtype, tiles, block_size, n_jobs=1):
+    """Computes hamming distances tile by tile into a new array of the given
+    shape and dtype, and returns it.
 
-def NW_mxs(a, b, method='bool', m=1, x=-1, s=-1):
+    Y=None means X is compared against itself, and the output is a condensed
+    vector (see self_similarity_matrix()); otherwise it is a
+    (len(X), len(Y)) matrix. Each tile is (i0, i1, j0, j1), a block of rows
+    of X vs a block of rows of Y.
+
+    With n_jobs > 1, tiles are distributed across a process pool. The
+    encoded inputs and the output are placed in shared memory, so that
+    workers don't receive pickled copies of the sequences, and write their
+    tiles straight into the output rather than returning them. The output is
+    copied into a regular array once all the tiles are done, and the shared
+    blocks are then released.
+    """
+    if n_jobs == -1:
+        n_jobs = os.cpu_count()
+    if n_jobs is None or n_jobs <= 1 or len(tiles) <= 1:
+        out = np.zeros(shape, dtype=dtype)
+        for tile in tiles:
+            _fill_hamming_tile(X, lx, Y, ly, out, tile, block_size)
+        return out
+
+    arrays = {"X": X, "lx": lx}
+    if Y is not None:
+        arrays["Y"] = Y
+        arrays["ly"] = ly
+    arrays["out"] = np.zeros(shape, dtype=dtype)
+    shms = {}
+    try:
+        specs = {}
+        for name, arr in arrays.items():
+            shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+            shms[name] = shm
+            np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+            specs[name] = (shm.name, arr.shape, arr.dtype.str)
+
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            futures = [pool.submit(_hamming_tile_worker, specs, tile, block_size)
+                       for tile in tiles]
+            for future in futures:
+                future.result()
+
+        out = arrays["out"]
+        out[...] = np.ndarray(shape, dtype=dtype, buffer=shms["out"].buf)
+    finally:
+        for shm in shms.values():
+            shm.close()
+            shm.unlink()
+
+    return out
+
+
+def _hamming_tile_worker(specs, tile, block_size):
+    """Process pool entry point for _run_hamming_tiles(): attaches to the
+    shared inputs and output by name, and fills in one tile.
+    """
+    shms = []
+    arrays = {}
+    for name, (shm_name, shape, dtype) in specs.items():
+        shm = shared_memory.SharedMemory(name=shm_name)
+        shms.append(shm)
+        arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+    try:
+        _fill_hamming_tile(arrays["X"], arrays["lx"], arrays.get("Y"),
+                           arrays.get("ly"), arrays["out"], tile, block_size)
+    finally:
+        del arrays
+        for shm in shms:
+            shm.close()
+
+
+def _fill_hamming_tile(X, lx, Y, ly, out, tile, block_size):
+    """Computes one tile of hamming distances, and writes it into out."""
+    i0, i1, j0, j1 = tile
+    if Y is not None:
+        out[i0:i1, j0:j1] = hamming_matrix(X[i0:i1], lx[i0:i1], Y[j0:j1],
+                                           ly[j0:j1], block_size=block_size)
+        return
+
+    n_seq = X.shape[0]
+    B = hamming_matrix(X[i0:i1], lx[i0:i1], X[j0:j1], lx[j0:j1],
+                       block_size=block_size)
+    for k in range(i1 - i0):
+        i = i0 + k
+        # the part of row i of the upper triangle in this tile, i.e. pairs
+        # (i, j) for max(j0, i+1) <= j < j1
+        j_start = max(j0, i + 1)
+        if j_start >= j1:
+            continue
+        start = condensed_index(n_seq, i, j_start)
+        out[start:start + j1 - j_start] = B[k, j_start-j0:]
+
+
+def NW_mxs(a, b, method='bool', m=1, x=-1, s=-1, score_only=False, band=None):
     """Take 2 strings, a and b, of lengths n1 and n2, and compute NW edit
     distance between them
     Compute a matrix S of shape n1+1 by n2+1, and recursively fill it.
@@ -97,12 +375,27 @@ def NW_mxs(a, b, method='bool', m=1, x=-1, s=-1):
     m: int, match score
     x: int, mismatch score
     s: int, 'gap' score
+    score_only: boolean. If True, only the final score H[n1][n2] is
+    computed, in linear memory. See NW_score().
+    band: int or 'auto'. If given, only cells within band of the diagonal
+    are computed and stored, and H and tr are returned in banded form (see
+    _banded_dp()). 'auto' starts with a narrow band and doubles it until the
+    score is proven optimal. Use band_score() to read off the score.
 
     Returns
     -------
     H: edit distance matrix
     tr: traceback matrix
     """
+    # 'bool' scores x for a match and 0 for a mismatch
+    match, mismatch = (x, 0) if method == 'bool' else (m, x)
+    if score_only:
+        return NW_score(a, b, m=match, x=mismatch, s=s)
+    if band is not None:
+        return _auto_band(a, b, band, dict(match=match, mismatch=mismatch,
+                                           up=s, left=s, row0=s, col0=s,
+                                           traceback=True))
+
     n1 = len(a)
     n2 = len(b)
     H = np.zeros([n1+1,n2+1])
@@ -146,7 +439,7 @@ def NW_mxs(a, b, method='bool', m=1, x=-1, s=-1):
 
     return H, tb
 
-def NW_match_mismatch(a, b, m=1, x=-1, s=-1):
+def NW_match_mismatch(a, b, m=1, x=-1, s=-1, score_only=False):
     """Take 2 strings, a and b, of lengths n1 and n2, and compute NW edit
     distance between them
     Compute a matrix S of shape n1+1 by n2+1, and recursively fill it.
@@ -157,12 +450,17 @@ def NW_match_mismatch(a, b, m=1, x=-1, s=-1):
     m: int, match score
     x: int, mismatch score
     s: int, 'gap' score
+    score_only: boolean. If True, only the final score H[n1][n2] is
+    computed, in linear memory. See NW_score().
 
     Returns
     -------
     H: edit distance matrix
     tr: traceback matrix
     """
+    if score_only:
+        return NW_score(a, b, m=m, x=x, s=s)
+
     n1 = len(a)
     n2 = len(b)
     H = np.zeros([n1+1,n2+1])
@@ -191,6 +489,437 @@ def NW_match_mismatch(a, b, m=1, x=-1, s=-1):
     return H, tb
 
 
+def NW_score(a, b, m=1, x=-1, s=-1, score_matrix=None):
+    """Computes only the NW score of aligning a and b, i.e. H[n1][n2] of
+    NW_match_mismatch(), in O(n2) memory: just the previous row of H is kept.
+
+    Each row is computed with a handful of NumPy operations, instead of cell
+    by cell. The substitution scores come from a lookup table with one row
+    per symbol of a, computed once. The within-row dependency on the left
+    neighbour (a gap in a) is resolved with a running maximum, since for a
+    linear gap score s,
+        H[i][j] = max_{k<=j} (T[k] + (j-k)*s),
+    where T[k] is the best of the diagonal and vertical moves into cell k.
+
+    Params
+    ------
+    a, b: input strings
+    m: int, match score
+    x: int, mismatch score
+    s: int, 'gap' score
+    score_matrix: optional substitution scores, replacing m and x; a name
+    accepted by score_table(), or a (256, 256) table.
+
+    Returns
+    -------
+    score: the optimal global alignment score.
+    """
+    table = None if score_matrix is None else score_table(score_matrix, m, x)
+    return _nw_last_row(a, b, m, x, s, table=table)[-1]
+
+
+def gotoh_score(a, b, score_matrix='nuc', gap_open=-5, gap_extend=-1,
+                local=False, m=1, x=-1):
+    """Alignment score of a and b with a substitution matrix and affine gap
+    scores (Gotoh's three-state algorithm), in linear memory. A gap of length
+    L scores gap_open + (L-1)*gap_extend, so gap_open should be no better
+    than gap_extend.
+
+    As in NW_score(), each DP row is a handful of NumPy operations: the
+    substitution scores are gathered from a precomputed table, vertical gaps
+    (F) only depend on the previous row, and horizontal gaps (E) reduce to a
+    running maximum:
+        E[j] = max_{k<j} (V[k] + gap_open + (j-1-k)*gap_extend),
+    where V = max(diagonal, F). This holds because, with
+    gap_open <= gap_extend, closing a gap and reopening one straight away is
+    never better than extending it.
+
+    Params
+    ------
+    a, b: input strings
+    score_matrix: a name accepted by score_table(), or a (256, 256) table.
+    gap_open, gap_extend: int; scores for the first, and each further,
+    position of a gap.
+    local: boolean. If True, computes the Smith-Waterman (local) score.
+    m, x: match/mismatch scores; only used with score_matrix='flat'.
+
+    Returns
+    -------
+    score: the optimal alignment score.
+    """
+    if gap_open > gap_extend:
+        raise ValueError("gap_open (%s) must be <= gap_extend (%s)" % (gap_open, gap_extend))
+    table = score_table(score_matrix, m, x)
+    n1 = len(a); n2 = len(b)
+    a_enc = np.frombuffer(a.encode('latin-1'), dtype=np.uint8)
+    b_enc = np.frombuffer(b.encode('latin-1'), dtype=np.uint8)
+
+    symbols, row_of = _symbol_rows(a_enc)
+    profile = table[symbols][:, b_enc].astype(np.float64)
+
+    js = np.arange(n2+1) * float(gap_extend)
+    H = np.zeros(n2+1)
+    if not local:
+        H[1:] = gap_open + js[:-1]
+    F = np.full(n2+1, -np.inf)
+    V = np.empty(n2+1)
+    E = np.full(n2+1, -np.inf)
+    best = 0.0
+    for i in range(1, n1+1):
+        # vertical gaps, from the previous row
+        np.maximum(F + gap_extend, H + gap_open, out=F)
+        # diagonal moves
+        np.maximum(H[:-1] + profile[row_of[a_enc[i-1]]], F[1:], out=V[1:])
+        V[0] = 0.0 if local else gap_open + (i-1)*gap_extend
+        if local:
+            np.maximum(V, 0.0, out=V)
+        # horizontal gaps, as a running max over V
+        E[1:] = gap_open - gap_extend + js[1:] + np.maximum.accumulate(V - js)[:-1]
+        np.maximum(V, E, out=H)
+        if local:
+            best = max(best, H.max())
+
+    if local:
+        return best
+    return H[n2]
+
+
+def score_table(score_matrix='nuc', m=1, x=-1):
+    """Builds (once, then caches) a (256, 256) substitution score table,
+    indexed by the byte values of the two characters, so that the DP
+    functions can look up a whole row of scores with one NumPy gather.
+    Tables are case-insensitive: a letter scores the same against either
+    case of another letter (so 'a' vs 'A' is a match).
+
+    Params
+    ------
+    score_matrix: one of
+        'flat': m for identical characters, x otherwise.
+        'nuc': IUPAC-aware nucleotide scores. Two codes score the expected
+        value of m/x over the bases they stand for, e.g. A vs R (A or G)
+        scores (m + x)/2. U is treated as T. Other characters (e.g. gaps)
+        score m vs themselves, x otherwise.
+        any matrix name known to Bio.Align.substitution_matrices, e.g.
+        'BLOSUM62', 'PAM250'. Characters outside its alphabet score x.
+        a (256, 256) array, which is returned as is.
+    m, x: match/mismatch scores for 'flat' and 'nuc'.
+
+    Returns
+    -------
+    table: float array, shape (256, 256).
+    """
+    if not isinstance(score_matrix, str):
+        table = np.asarray(score_matrix)
+        if table.shape != (256, 256):
+            raise ValueError("score tables must have shape (256, 256)")
+        return table
+
+    cache_key = (score_matrix, m, x)
+    if cache_key in _SCORE_TABLES:
+        return _SCORE_TABLES[cache_key]
+
+    table = np.full((256, 256), float(x))
+    np.fill_diagonal(table, float(m))
+    for c in map(chr, range(ord('A'), ord('Z') + 1)):
+        _set_score(table, c, c, float(m))
+    if score_matrix == 'flat':
+        pass
+    elif score_matrix == 'nuc':
+        for c1, bases1 in _IUPAC_CODES.items():
+            for c2, bases2 in _IUPAC_CODES.items():
+                p = len(bases1 & bases2) / (len(bases1)*len(bases2))
+                _set_score(table, c1, c2, p*m + (1-p)*x)
+    else:
+        from Bio.Align import substitution_matrices
+        bio_matrix = substitution_matrices.load(score_matrix)
+        table[:] = x
+        for c1 in bio_matrix.alphabet:
+            for c2 in bio_matrix.alphabet:
+                _set_score(table, c1, c2, bio_matrix[c1][c2])
+
+    table.setflags(write=False)
+    _SCORE_TABLES[cache_key] = table
+    return table
+
+
+def _set_score(table, c1, c2, score):
+    """Sets the score of c1 vs c2 in a byte-indexed table, for both cases."""
+    for k1 in {ord(c1.upper()), ord(c1.lower())}:
+        for k2 in {ord(c2.upper()), ord(c2.lower())}:
+            table[k1, k2] = score
+
+
+_IUPAC_CODES = {"A": {"A"}, "C": {"C"}, "G": {"G"}, "T": {"T"}, "U": {"T"},
+                "R": {"A", "G"}, "Y": {"C", "T"}, "S": {"C", "G"},
+                "W": {"A", "T"}, "K": {"G", "T"}, "M": {"A", "C"},
+                "B": {"C", "G", "T"}, "D": {"A", "G", "T"},
+                "H": {"A", "C", "T"}, "V": {"A", "C", "G"},
+                "N": {"A", "C", "G", "T"}}
+
+# Substitution tables built by score_table(), keyed by (name, m, x).
+_SCORE_TABLES = {}
+
+
+def NW_hirschberg(a, b, m=1, x=-1, s=-1):
+    """Recovers an optimal NW alignment of a and b in linear memory, using
+    Hirschberg's divide-and-conquer algorithm: a is split in half, and the
+    split point in b is found from the forward score row of the first half
+    and the reverse score row of the second half (both from _nw_last_row()).
+    The two halves are then aligned recursively.
+
+    Params
+    ------
+    a, b: input strings
+    m: int, match score
+    x: int, mismatch score
+    s: int, 'gap' score
+
+    Returns
+    -------
+    a_aln, b_aln: str; a and b with '-' inserted for gaps.
+    score: the alignment's score, i.e. NW_score(a, b, m, x, s).
+    """
+    a_aln, b_aln = _hirschberg(a, b, m, x, s)
+    # rescored rather than read off the alignment, since a and b may already
+    # contain '-'
+    score = NW_score(a, b, m=m, x=x, s=s)
+    return a_aln, b_aln, score
+
+
+def _hirschberg(a, b, m, x, s):
+    """Recursive step of NW_hirschberg()."""
+    n1 = len(a); n2 = len(b)
+    if n1 == 0:
+        return '-'*n2, b
+    if n2 == 0:
+        return a, '-'*n1
+    if n1 == 1 or n2 == 1:
+        # small enough for the full matrices
+        H, tb = NW_match_mismatch(a, b, m=m, x=x, s=s)
+        return _nw_traceback(a, b, tb)
+
+    mid = n1 // 2
+    fwd = _nw_last_row(a[:mid], b, m, x, s)
+    rev = _nw_last_row(a[mid:][::-1], b[::-1], m, x, s)
+    k = int(np.argmax(fwd + rev[::-1]))
+    a1, b1 = _hirschberg(a[:mid], b[:k], m, x, s)
+    a2, b2 = _hirschberg(a[mid:], b[k:], m, x, s)
+    return a1 + a2, b1 + b2
+
+
+def _nw_traceback(a, b, tb):
+    """Follows a traceback matrix from NW_match_mismatch() back from
+    (n1, n2), and returns the aligned strings.
+    """
+    i = len(a); j = len(b)
+    a_aln = []; b_aln = []
+    while i > 0 or j > 0:
+        if i == 0:
+            di, dj = 0, -1
+        elif j == 0:
+            di, dj = -1, 0
+        else:
+            di, dj = tb[i][j]
+        a_aln.append(a[i-1] if di else '-')
+        b_aln.append(b[j-1] if dj else '-')
+        i += di; j += dj
+    return "".join(reversed(a_aln)), "".join(reversed(b_aln))
+
+
+def _nw_last_row(a, b, m, x, s, table=None):
+    """Returns the last row of the NW matrix H for a vs b, i.e.
+    H[n1][0..n2], keeping only two rows in memory. See NW_score().
+
+    The DP runs on G[j] = H[j] - j*s, in which the left-gap recurrence is a
+    plain running maximum, G[j] = max_{k<=j} T[k].
+    """
+    n1 = len(a); n2 = len(b)
+    a_enc = np.frombuffer(a.encode('latin-1'), dtype=np.uint8)
+    b_enc = np.frombuffer(b.encode('latin-1'), dtype=np.uint8)
+    if table is None:
+        dt = _score_dtype((m, x, s), n1 + n2)
+    else:
+        dt = np.result_type(table.dtype, _score_dtype((s,), n1 + n2), np.int64)
+
+    # substitution lookup, shifted into G: profile[row_of[c]][j] = score of
+    # c vs b[j], minus s
+    symbols, row_of = _symbol_rows(a_enc)
+    profile = np.empty((len(symbols), n2), dtype=dt)
+    for k, c in enumerate(symbols):
+        if table is None:
+            profile[k] = np.where(b_enc == c, m - s, x - s)
+        else:
+            profile[k] = table[c, b_enc] - s
+
+    G = np.zeros(n2+1, dtype=dt)
+    T = np.empty(n2+1, dtype=dt)
+    diag = np.empty(n2, dtype=dt)
+    for i in range(1, n1+1):
+        T[0] = i*s
+        np.add(G[:-1], profile[row_of[a_enc[i-1]]], out=diag)
+        np.add(G[1:], s, out=T[1:])
+        np.maximum(T[1:], diag, out=T[1:])
+        np.maximum.accumulate(T, out=G)
+    return G + np.arange(n2+1, dtype=dt) * s
+
+
+def _symbol_rows(enc):
+    """Returns the distinct symbols of a uint8-encoded sequence, and a
+    256-long lookup from symbol to its row in a per-symbol table.
+    """
+    symbols = np.unique(enc)
+    row_of = np.zeros(256, dtype=np.intp)
+    row_of[symbols] = np.arange(len(symbols))
+    return symbols, row_of
+
+
+def _score_dtype(scores, max_steps):
+    """Smallest dtype that can hold any DP score of an alignment of up to
+    max_steps columns: int32 or int64 if all the scores are ints, float64
+    otherwise.
+    """
+    if not all(isinstance(sc, (int, np.integer)) for sc in scores):
+        return np.float64
+    bound = (max_steps + 1) * max(abs(int(sc)) for sc in scores)
+    if bound < np.iinfo(np.int32).max:
+        return np.int32
+    return np.int64
+
+
+def NW_batch(ref, queries, m=1, x=-1, s=-1, return_alignments=False,
+             batch_size=32, score_matrix=None):
+    """Global (NW) alignment scores of one reference against many queries.
+    Equivalent to calling NW_score(ref, q, m, x, s) for every q in queries,
+    but the DP is vectorized across queries: the queries are padded to equal
+    length and stacked, so that each NumPy operation advances the DP row of
+    the whole batch by one reference position. Each query's score is read
+    off at its own length, so padding never affects the result.
+
+    Params
+    ------
+    ref: str; the reference.
+    queries: list of str.
+    m: int, match score
+    x: int, mismatch score
+    s: int, 'gap' score
+    return_alignments: boolean. If True, also returns the alignment of each
+    query, from NW_hirschberg() (one query at a time). Only supported with
+    m/x scoring.
+    batch_size: int; no. of queries in the DP at once. Small batches keep
+    the DP rows in cache.
+    score_matrix: optional substitution scores, replacing m and x, as in
+    NW_score().
+
+    Returns
+    -------
+    scores: array, shape (len(queries),).
+    alignments: list of (ref_aln, query_aln) tuples; only if
+    return_alignments.
+    """
+    if return_alignments and score_matrix is not None:
+        raise ValueError("return_alignments is only supported with m/x scoring")
+    table = None if score_matrix is None else score_table(score_matrix, m, x)
+    r_enc = np.frombuffer(ref.encode('latin-1'), dtype=np.uint8)
+    max_q = max([len(q) for q in queries], default=0)
+    dt = _batch_dtype(m, x, s, len(ref) + max_q, table)
+    scores = np.zeros(len(queries), dtype=dt)
+
+    for q0 in range(0, len(queries), batch_size):
+        Q, lq = encode_seqs(queries[q0:q0 + batch_size])
+        profile, row_of = _batch_profile(r_enc, Q, m, x, s, dt, table)
+        # DP on G = H - j*s, as in _nw_last_row()
+        G = np.zeros((Q.shape[0], Q.shape[1]+1), dtype=dt)
+        T = np.empty_like(G)
+        diag = np.empty_like(Q, dtype=dt)
+        for i in range(1, len(r_enc)+1):
+            T[:, 0] = i*s
+            np.add(G[:, :-1], profile[row_of[r_enc[i-1]]], out=diag)
+            np.add(G[:, 1:], s, out=T[:, 1:])
+            np.maximum(T[:, 1:], diag, out=T[:, 1:])
+            np.maximum.accumulate(T, axis=1, out=G)
+        scores[q0:q0 + Q.shape[0]] = G[np.arange(Q.shape[0]), lq] + lq*s
+
+    if return_alignments:
+        alignments = [NW_hirschberg(ref, q, m=m, x=x, s=s)[:2] for q in queries]
+        return scores, alignments
+    return scores
+
+
+def SW_batch(ref, queries, m=1, s=-1, x=-1, batch_size=32, score_matrix=None):
+    """Local (SW) alignment scores of one reference against many queries,
+    vectorized across queries like NW_batch(). Equivalent to
+    smithwaterman_mod(ref, q, m, s, x).max() for every q in queries. Padded
+    positions past the end of each query are masked out of its maximum.
+
+    Params
+    ------
+    ref: str; the reference.
+    queries: list of str.
+    m: int, match score
+    s: int, 'gap' score
+    x: int, mismatch score
+    batch_size: int; no. of queries in the DP at once.
+    score_matrix: optional substitution scores, replacing m and x; a name
+    accepted by score_table(), or a (256, 256) table.
+
+    Returns
+    -------
+    scores: array, shape (len(queries),).
+    """
+    table = None if score_matrix is None else score_table(score_matrix, m, x)
+    r_enc = np.frombuffer(ref.encode('latin-1'), dtype=np.uint8)
+    max_q = max([len(q) for q in queries], default=0)
+    dt = _batch_dtype(m, x, s, len(ref) + max_q, table)
+    scores = np.zeros(len(queries), dtype=dt)
+
+    for q0 in range(0, len(queries), batch_size):
+        Q, lq = encode_seqs(queries[q0:q0 + batch_size])
+        profile, row_of = _batch_profile(r_enc, Q, m, x, s, dt, table)
+        js = np.arange(Q.shape[1]+1, dtype=dt) * s
+        valid = (np.arange(Q.shape[1]+1)[None, :] <= lq[:, None]).astype(dt)
+        # DP on G = H - j*s; the floor of 0 on H becomes a floor of -j*s
+        G = np.tile(-js, (Q.shape[0], 1))
+        T = np.zeros_like(G)
+        H = np.empty_like(G)
+        diag = np.empty_like(Q, dtype=dt)
+        best = np.zeros(Q.shape[0], dtype=dt)
+        for i in range(1, len(r_enc)+1):
+            np.add(G[:, :-1], profile[row_of[r_enc[i-1]]], out=diag)
+            np.add(G[:, 1:], s, out=T[:, 1:])
+            np.maximum(T[:, 1:], diag, out=T[:, 1:])
+            np.maximum(T[:, 1:], -js[1:], out=T[:, 1:])
+            np.maximum.accumulate(T, axis=1, out=G)
+            # H >= 0, so masking by multiplication is safe
+            np.add(G, js, out=H)
+            np.multiply(H, valid, out=H)
+            np.maximum(best, H.max(axis=1), out=best)
+        scores[q0:q0 + Q.shape[0]] = best
+
+    return scores
+
+
+def _batch_profile(r_enc, Q, m, x, s, dt, table=None):
+    """Substitution lookup for a batch of encoded queries Q, shifted into G:
+    profile[row_of[c]] = where(Q == c, m, x) - s, or table[c, Q] - s, for
+    every symbol c of r_enc.
+    """
+    symbols, row_of = _symbol_rows(r_enc)
+    profile = np.empty((len(symbols),) + Q.shape, dtype=dt)
+    for k, c in enumerate(symbols):
+        if table is None:
+            profile[k] = np.where(Q == c, m - s, x - s)
+        else:
+            profile[k] = table[c, Q] - s
+    return profile, row_of
+
+
+def _batch_dtype(m, x, s, max_steps, table=None):
+    """DP dtype for NW_batch() and SW_batch(); see _score_dtype()."""
+    if table is None:
+        return _score_dtype((m, x, s), max_steps)
+    return np.result_type(table.dtype, _score_dtype((s,), max_steps), np.int64)
+
+
 def smithwaterman(a, b, m=1, s=-1, x=-1):
     """Basic Smithwaterman algo. Initializes the first row and column as 0."""
     n1 = len(a)
@@ -222,8 +951,18 @@ def smithwaterman(a, b, m=1, s=-1, x=-1):
     return H
 
 
-def smithwaterman_mod(a, b, m=1, s=-1, x=-1):
-    """Modified such that only the first col is initialized at 0"""
+def smithwaterman_mod(a, b, m=1, s=-1, x=-1, band=None):
+    """Modified such that only the first col is initialized at 0
+
+    With band=int, only cells within band of the diagonal are computed and
+    stored, and H is returned in banded form (see _banded_dp()).
+    """
+    if band is not None:
+        if band == 'auto':
+            raise ValueError("band='auto' is only supported for global alignment")
+        return _banded_dp(a, b, band, match=m, mismatch=x, up=s, left=s,
+                          row0=0, col0=0, floor=0)
+
     n1 = len(a); n2 = len(b)
     H = np.zeros([n1+1,n2+1])
     dt = np.dtype("i4, i4")
@@ -253,8 +992,17 @@ def smithwaterman_mod(a, b, m=1, s=-1, x=-1):
 
 
 
-def NW_kt(a, b, m=0, ins=1, dl=1, s=1, verbose=False):
-    """The version from Knowledge Tech course."""
+def NW_kt(a, b, m=0, ins=1, dl=1, s=1, verbose=False, band=None):
+    """The version from Knowledge Tech course.
+
+    With band=int or 'auto', only cells within band of the diagonal are
+    computed and stored, and H is returned in banded form. See NW_mxs().
+    """
+    if band is not None:
+        return _auto_band(a, b, band, dict(match=m, mismatch=s, up=dl,
+                                           left=ins, row0=dl, col0=ins,
+                                           minimize=True))
+
     n1 = len(a)
     n2 = len(b)
     H = np.zeros([n1+1,n2+1])
@@ -286,6 +1034,156 @@ def NW_kt(a, b, m=0, ins=1, dl=1, s=1, verbose=False):
     return H
 
 
+def band_score(H, n2):
+    """Reads the final score H[n1][n2] off a banded matrix, as returned by
+    NW_mxs(), NW_kt() or smithwaterman_mod() with band set.
+    """
+    n1 = H.shape[0] - 1
+    k = (H.shape[1] - 1) // 2
+    return H[n1, n2 - n1 + k]
+
+
+def band_to_full(H, n2, fill=np.nan):
+    """Expands a banded matrix into the full (n1+1, n2+1) matrix, with fill
+    outside the band. Only meant for inspecting small alignments.
+    """
+    n1 = H.shape[0] - 1
+    k = (H.shape[1] - 1) // 2
+    full = np.full((n1+1, n2+1), fill, dtype=H.dtype)
+    for i in range(n1+1):
+        j0 = max(0, i - k); j1 = min(n2, i + k)
+        full[i, j0:j1+1] = H[i, j0-i+k:j1-i+k+1]
+    return full
+
+
+def _auto_band(a, b, band, params):
+    """Runs _banded_dp() with a fixed band, or for band='auto', with a band
+    that starts narrow and doubles until the score is proven optimal, i.e.
+    until no alignment that leaves the band could beat it.
+
+    An alignment that strays more than k cells off the diagonal needs at
+    least g = 2*(k+1) - |n1-n2| gaps, leaving at most (n1+n2-g)/2 diagonal
+    steps, which bounds its score. Once the banded score reaches that bound,
+    widening the band further cannot change it.
+    """
+    n1 = len(a); n2 = len(b)
+    if band != 'auto':
+        return _banded_dp(a, b, band, **params)
+
+    minimize = params.get('minimize', False)
+    pick = min if minimize else max
+    best_diag = pick(params['match'], params['mismatch'])
+    best_gap = pick(params['up'], params['left'])
+    k = max(abs(n1 - n2), 8)
+    while True:
+        res = _banded_dp(a, b, k, **params)
+        H = res[0] if params.get('traceback') else res
+        if k >= max(n1, n2):
+            return res
+
+        g = 2*(k+1) - abs(n1 - n2)
+        bound = (n1 + n2 - g)/2 * best_diag + g*best_gap
+        # the bound is only valid if gaps are worse than diagonal steps
+        if minimize:
+            proven = best_gap > best_diag/2 and band_score(H, n2) <= bound
+        else:
+            proven = best_gap < best_diag/2 and band_score(H, n2) >= bound
+        if proven:
+            return res
+        k *= 2
+
+
+def _banded_dp(a, b, k, match, mismatch, up, left, row0, col0,
+               minimize=False, floor=None, traceback=False):
+    """Fills only the cells of the DP matrix within k of the diagonal, i.e.
+    with |j - i| <= k, in O(n1*k) time and memory. k is widened to |n1 - n2|
+    if needed, so that the band always contains cell (n1, n2).
+
+    The result is stored by diagonal offset: H[i, d] holds the full matrix's
+    H[i][i+d-k], for d in 0..2k. Cells outside the matrix are -inf (+inf
+    when minimizing). Each row is computed with NumPy, resolving the
+    within-row left-gap dependency with a running max (min), like
+    _nw_last_row().
+
+    Only match/mismatch scoring is supported here, so the banded modes of
+    NW_mxs(), NW_kt() and smithwaterman_mod() don't take score tables; use
+    NW_score() or NW_batch() with score_matrix for those.
+
+    Params
+    ------
+    a, b: input strings
+    k: int; band half-width.
+    match, mismatch: diagonal scores.
+    up, left: scores of H[i-1][j] -> H[i][j] and H[i][j-1] -> H[i][j].
+    row0, col0: per-step scores of the boundaries, H[0][j] = j*row0 and
+    H[i][0] = i*col0.
+    minimize: boolean; min instead of max, as in NW_kt().
+    floor: if not None, every cell is at least floor, as in Smith-Waterman.
+    traceback: boolean; also return a banded traceback matrix, with the
+    same tie-breaking as NW_mxs().
+
+    Returns
+    -------
+    H: float array, shape (n1+1, 2k+1).
+    tb: structured (i4, i4) array, same shape; only if traceback.
+    """
+    n1 = len(a); n2 = len(b)
+    k = max(int(k), abs(n1 - n2))
+    width = 2*k + 1
+    op = np.minimum if minimize else np.maximum
+    bad = np.inf if minimize else -np.inf
+    a_enc = np.frombuffer(a.encode('latin-1'), dtype=np.uint8)
+    b_enc = np.frombuffer(b.encode('latin-1'), dtype=np.uint8)
+
+    D = np.arange(width)
+    H = np.full((n1+1, width), bad)
+    if traceback:
+        tb = np.zeros((n1+1, width), dtype=np.dtype("i4, i4"))
+
+    j = D - k
+    in_row = (j >= 0) & (j <= n2)
+    H[0, in_row] = j[in_row] * row0
+
+    up_val = np.empty(width)
+    for i in range(1, n1+1):
+        j = i - k + D
+        valid = (j >= 1) & (j <= n2)
+        b_j = b_enc[np.clip(j - 1, 0, max(n2 - 1, 0))] if n2 > 0 else np.zeros(width, np.uint8)
+        sub = np.where(b_j == a_enc[i-1], match, mismatch)
+
+        prev = H[i-1]
+        diag_val = prev + sub
+        up_val[:-1] = prev[1:] + up
+        up_val[-1] = bad
+        T = op(diag_val, up_val)
+        if floor is not None:
+            T = op(T, floor)
+        T[~valid] = bad
+        d0 = k - i
+        if 0 <= d0 < width:
+            T[d0] = i*col0
+
+        # left gaps: H[d] = op(T[d], H[d-1] + left)
+        row = op.accumulate(T - D*left) + D*left
+        row[~valid] = bad
+        if 0 <= d0 < width:
+            row[d0] = i*col0
+        H[i] = row
+
+        if traceback:
+            left_val = np.full(width, bad)
+            left_val[1:] = row[:-1] + left
+            is_diag = valid & (row == diag_val)
+            is_up = valid & ~is_diag & (row == up_val)
+            is_left = valid & ~is_diag & ~is_up & (row == left_val)
+            tb['f0'][i, is_diag | is_up] = -1
+            tb['f1'][i, is_diag | is_left] = -1
+
+    if traceback:
+        return H, tb
+    return H
+
+
 def _bool_match(x1,x2):
     """returns 1 if the single str characters x1 == x2,
     0 otherwise
@@ -309,6 +1207,304 @@ def _match_mismatch(x1, x2, m, x):
     return score
 
 
+def collapse_duplicates(df, seq_col='seq', id_col='name_id', max_dist=0,
+                        k=16, n_hashes=32, n_bands=8, max_bucket=1000, seed=0):
+    """Collapses identical and near-identical sequences into clusters, each
+    represented by one sequence.
+
+    Exact duplicates are found in O(n) by hashing the sequences
+    (pd.factorize). With max_dist > 0, near-duplicates among the distinct
+    sequences are found without comparing all pairs: each sequence gets a
+    MinHash sketch of its k-mers (see minhash_signatures()), sketches are
+    split into n_bands bands, and only sequences that share a whole band
+    (an LSH bucket) are compared, with the vectorized hamming_matrix().
+    Pairs within max_dist are merged into clusters by single linkage.
+
+    Distances are hamming distances in which every position past the end of
+    the shorter sequence counts as a mismatch, so sequences of different
+    lengths are never merged at distance 0.
+
+    Params
+    ------
+    df: input dataframe, one sequence per row.
+    seq_col: name of the sequence column.
+    id_col: name of the column identifying each row (e.g. 'name_id').
+    max_dist: int; max. hamming distance for two sequences to be merged.
+    0 only collapses exact duplicates.
+    k: int; k-mer length for MinHash.
+    n_hashes: int; MinHash sketch size. Must be divisible by n_bands.
+    n_bands: int; no. of LSH bands. More bands find more distant pairs, at
+    the cost of more comparisons.
+    max_bucket: int; buckets bigger than this are sorted by sequence and
+    split into sub-buckets of max_bucket, which are compared within
+    themselves and against the bucket's first member, to bound the work on
+    highly redundant data. Near-duplicates that land in different
+    sub-buckets (and share no other bucket) can be missed, so a warning is
+    printed when this happens.
+    seed: int; seed for the MinHash functions.
+
+    Returns
+    -------
+    reps: the rows of df that represent each cluster (the most common
+    sequence in the cluster, first occurrence), with 'cluster' and
+    'cluster_size' columns added.
+    members: dataframe with one row per row of df, and columns id_col,
+    'cluster', 'rep_id' (the id_col of the cluster's representative) and
+    'dist_to_rep' (distance to the representative, as above). Join it back
+    to df on id_col. Rows with no sequence (e.g. a segment missing from a
+    pivot_raw_tbl() column) get cluster -1, and NaN rep_id and dist_to_rep.
+    """
+    is_na = df[seq_col].isna().to_numpy()
+    if is_na.any():
+        reps, members = collapse_duplicates(df[~is_na], seq_col=seq_col, id_col=id_col,
+                                            max_dist=max_dist, k=k, n_hashes=n_hashes,
+                                            n_bands=n_bands, max_bucket=max_bucket, seed=seed)
+        na_members = pd.DataFrame({id_col: df[id_col].values[is_na],
+                                   "cluster": -1,
+                                   "rep_id": np.nan,
+                                   "dist_to_rep": np.nan},
+                                  index=df.index[is_na])
+        # back into the row order of df
+        order = np.argsort(np.concatenate([np.flatnonzero(~is_na), np.flatnonzero(is_na)]), kind='stable')
+        members = pd.concat([members, na_members]).iloc[order]
+        return reps, members
+
+    seq_codes, uniques = pd.factorize(df[seq_col])
+    uniques = list(uniques)
+    n_uq = len(uniques)
+    # the first row for each distinct sequence, and its no. of copies
+    first_row = np.full(n_uq, -1, dtype=np.int64)
+    first_row[seq_codes[::-1]] = np.arange(len(seq_codes))[::-1]
+    n_copies = np.bincount(seq_codes, minlength=n_uq)
+
+    parent = list(range(n_uq))
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    n_split = 0
+    if max_dist > 0 and n_uq > 1:
+        sig = minhash_signatures(uniques, k=k, n_hashes=n_hashes, seed=seed)
+        rows = n_hashes // n_bands
+        for band in range(n_bands):
+            band_sig = np.ascontiguousarray(sig[:, band*rows:(band+1)*rows])
+            band_keys = band_sig.view(np.dtype((np.void, band_sig.dtype.itemsize*rows))).ravel()
+            _, bucket = np.unique(band_keys, return_inverse=True)
+            order = np.argsort(bucket, kind='stable')
+            bounds = np.flatnonzero(np.diff(bucket[order])) + 1
+            for members in np.split(order, bounds):
+                if len(members) < 2:
+                    continue
+                if len(members) <= max_bucket:
+                    pairs = [(members, members)]
+                else:
+                    # sorted, so that near-identical sequences tend to share
+                    # a sub-bucket
+                    n_split += 1
+                    members = np.array(sorted(members, key=lambda i: uniques[i]))
+                    pairs = [(members[:1], members)]
+                    pairs += [(sub, sub) for sub in np.array_split(members, -(-len(members) // max_bucket))]
+                for queries, targets in pairs:
+                    for qi, mi in zip(*np.nonzero(_padded_hamming(uniques, queries, targets) <= max_dist)):
+                        ra = find(int(queries[qi])); rb = find(int(targets[mi]))
+                        if ra != rb:
+                            parent[rb] = ra
+    if n_split > 0:
+        print("WARNING: %s LSH buckets had more than max_bucket=%s sequences, and were split; "
+              "near-duplicates across their sub-buckets may be missed" % (n_split, max_bucket))
+
+    roots = np.array([find(i) for i in range(n_uq)], dtype=np.int64)
+    cluster_of_uq, cluster_roots = pd.factorize(roots)
+    n_clusters = len(cluster_roots)
+
+    # representative: the distinct sequence with the most copies in each
+    # cluster; ties go to the earliest in df
+    order = np.lexsort((first_row, -n_copies, cluster_of_uq))
+    is_first = np.ones(len(order), dtype=bool)
+    is_first[1:] = cluster_of_uq[order][1:] != cluster_of_uq[order][:-1]
+    rep_uq = np.empty(n_clusters, dtype=np.int64)
+    rep_uq[cluster_of_uq[order][is_first]] = order[is_first]
+
+    cluster = cluster_of_uq[seq_codes]
+    rep_rows = first_row[rep_uq]
+    ids = df[id_col].values
+    dist_uq = np.zeros(n_uq, dtype=np.int64)
+    for u in np.flatnonzero(rep_uq[cluster_of_uq] != np.arange(n_uq)):
+        a = uniques[u]; b = uniques[rep_uq[cluster_of_uq[u]]]
+        dist_uq[u] = string_similarity(a, b, verbose=False) + abs(len(a) - len(b))
+
+    members = pd.DataFrame({id_col: ids,
+                            "cluster": cluster,
+                            "rep_id": ids[rep_rows[cluster]],
+                            "dist_to_rep": dist_uq[seq_codes]},
+                           index=df.index)
+
+    reps = df.iloc[rep_rows].copy()
+    reps["cluster"] = np.arange(n_clusters)
+    reps["cluster_size"] = np.bincount(cluster, minlength=n_clusters)
+    return reps, members
+
+
+def _padded_hamming(seq_ls, idx1, idx2):
+    """hamming_matrix() between seq_ls[idx1] and seq_ls[idx2], plus the
+    difference in length of each pair, i.e. positions past the end of the
+    shorter sequence count as mismatches.
+    """
+    X, lx = encode_seqs([seq_ls[i] for i in idx1])
+    Y, ly = encode_seqs([seq_ls[i] for i in idx2])
+    return hamming_matrix(X, lx, Y, ly) + np.abs(lx[:, None] - ly[None, :])
+
+
+def minhash_signatures(seq_ls, k=16, n_hashes=32, seed=0):
+    """MinHash sketches of the k-mer sets of a list of sequences. k-mers are
+    hashed with a rolling polynomial hash over the raw bytes (k vectorized
+    steps per sequence), then each of n_hashes multiply-shift hash functions
+    keeps its minimum over the sequence's k-mers. Two sequences agree on any
+    one sketch position with probability equal to the Jaccard similarity of
+    their k-mer sets. Sequences shorter than k are hashed whole.
+
+    Returns
+    -------
+    sig: uint64 array, shape (len(seq_ls), n_hashes).
+    """
+    rng = np.random.RandomState(seed)
+    mult = rng.randint(1, 2**62, size=n_hashes, dtype=np.int64).astype(np.uint64) * np.uint64(2) + np.uint64(1)
+    add = rng.randint(0, 2**62, size=n_hashes, dtype=np.int64).astype(np.uint64)
+    base = np.uint64(1099511628211)
+
+    sig = np.zeros((len(seq_ls), n_hashes), dtype=np.uint64)
+    for i, seq in enumerate(seq_ls):
+        codes = np.frombuffer(seq.encode('latin-1'), dtype=np.uint8).astype(np.uint64)
+        kk = min(k, len(codes))
+        n_kmers = len(codes) - kk + 1
+        h = np.zeros(n_kmers, dtype=np.uint64)
+        for t in range(kk):
+            h = h * base + codes[t:t + n_kmers]
+        h = np.unique(h)
+        hashed = h[:, None] * mult[None, :] + add[None, :]
+        hashed ^= hashed >> np.uint64(29)
+        sig[i] = hashed.min(axis=0)
+    return sig
+
+
+def column_counts(seq_ls, alphabet="ACGT-N", counts=None):
+    """Counts the characters in every column of an MSA. The sequences are
+    encoded once into a uint8 matrix, mapped to symbol indices with a
+    256-long lookup table, and counted per column with one vectorized
+    reduction per symbol.
+
+    Counts can be accumulated chunk by chunk by passing the previous result
+    back in as counts, so that alignments larger than memory can be profiled
+    (see column_counts_stream()).
+
+    Params
+    ------
+    seq_ls: list of str; aligned sequences. Sequences shorter than the
+    alignment are treated as missing (not gaps) past their end.
+    alphabet: str; the symbols to count, case-insensitive. Everything else is
+    counted in a final 'other' column. If '-' is in the alphabet, '.' counts
+    as '-' too.
+    counts: int array from a previous call, to be added to.
+
+    Returns
+    -------
+    counts: int64 array, shape (n_cols, len(alphabet)+1).
+    """
+    lut = _symbol_lut(alphabet)
+    n_sym = len(alphabet) + 1
+    X, lens = encode_seqs(seq_ls)
+    S = lut[X]
+    # padding past the end of shorter sequences is not counted
+    S[np.arange(X.shape[1])[None, :] >= lens[:, None]] = 255
+
+    chunk_counts = np.zeros((X.shape[1], n_sym), dtype=np.int64)
+    for k in range(n_sym):
+        chunk_counts[:, k] = (S == k).sum(axis=0)
+
+    if counts is None:
+        return chunk_counts
+    n_cols = max(counts.shape[0], chunk_counts.shape[0])
+    total = np.zeros((n_cols, n_sym), dtype=np.int64)
+    total[:counts.shape[0]] += counts
+    total[:chunk_counts.shape[0]] += chunk_counts
+    return total
+
+
+def column_counts_stream(seq_iter, alphabet="ACGT-N", chunk_size=10000):
+    """column_counts() over an iterable of sequences, e.g.
+    (row[-1] for row in iter_fasta(fn)), accumulated chunk_size sequences at
+    a time so that only one chunk is ever held in memory.
+    """
+    counts = None
+    chunk = []
+    for seq in seq_iter:
+        chunk.append(seq)
+        if len(chunk) == chunk_size:
+            counts = column_counts(chunk, alphabet=alphabet, counts=counts)
+            chunk = []
+    if len(chunk) > 0 or counts is None:
+        counts = column_counts(chunk, alphabet=alphabet, counts=counts)
+    return counts
+
+
+def column_profile(counts, alphabet="ACGT-N"):
+    """Per-column profile of an MSA, from the output of column_counts().
+
+    Params
+    ------
+    counts: int array, shape (n_cols, len(alphabet)+1).
+    alphabet: str; the alphabet counts were computed with.
+
+    Returns
+    -------
+    profile: dataframe with one row per column, and columns
+        one count column per symbol, plus 'other'.
+        depth: no. of sequences covering the column.
+        consensus: the most frequent symbol (gaps included; 'X' for other).
+        entropy: Shannon entropy of the symbol frequencies, in bits.
+        gap_frac: fraction of depth that is '-'.
+    """
+    counts = np.asarray(counts)
+    depth = counts.sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        freqs = counts / depth[:, None]
+        plogp = np.where(counts > 0, freqs * np.log2(freqs), 0.0)
+    entropy = -plogp.sum(axis=1)
+
+    symbols = np.array(list(alphabet.upper()) + ["X"])
+    consensus = symbols[counts.argmax(axis=1)]
+    consensus[depth == 0] = ""
+
+    profile = pd.DataFrame(counts, columns=list(alphabet.upper()) + ["other"])
+    profile["depth"] = depth
+    profile["consensus"] = consensus
+    profile["entropy"] = entropy
+    if "-" in alphabet:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            profile["gap_frac"] = counts[:, alphabet.index("-")] / depth
+    else:
+        profile["gap_frac"] = 0.0
+    profile.index.name = "col"
+    return profile
+
+
+def _symbol_lut(alphabet):
+    """256-long lookup from byte value to symbol index in alphabet
+    (case-insensitive), len(alphabet) for anything else, and 255 for the
+    padding byte 0.
+    """
+    lut = np.full(256, len(alphabet), dtype=np.uint8)
+    for k, ch in enumerate(alphabet):
+        lut[ord(ch.upper())] = k
+        lut[ord(ch.lower())] = k
+    if "-" in alphabet:
+        lut[ord(".")] = alphabet.index("-")
+    lut[0] = 255
+    return lut
+
+
 def replace_chars(char_ls, new_char, my_string):
     """Given my_string, replaces all occurrences of characters in char_ls with
     new_char.
@@ -323,9 +1519,120 @@ def replace_chars(char_ls, new_char, my_string):
     return my_string
 
 
-def msa_screen(df, seq_col, min_len=0.8, char_ls=["-", "n"]):
+def seq_metrics(seq_ls, char_ls=["-", "n"], chunk_residues=1 << 22):
+    """Computes per-sequence QC metrics straight from the raw bytes, without
+    building any ungapped copies of the sequences. Sequences are processed in
+    chunks: each chunk is concatenated into one byte buffer, and a single
+    np.bincount gives a (chunk, 256) table of character counts, from which
+    every metric is a masked sum. Chunks are sized by their total no. of
+    residues, so the temporaries stay small however long the sequences are.
+
+    Params
+    ------
+    seq_ls: list of str.
+    char_ls: list of single characters removed when computing the ungapped
+    length, as in msa_screen().
+    chunk_residues: int; max. no. of residues per chunk (each sequence also
+    counts as 1, so that chunks of empty sequences are bounded too). A
+    sequence longer than this gets a chunk of its own.
+
+    Returns
+    -------
+    metrics: dataframe with one row per sequence, and columns
+        aln_len: length of the sequence as given.
+        len: ungapped length, i.e. aln_len minus the characters in char_ls.
+        gap_frac: fraction of aln_len that is '-' or '.'.
+        ambig_frac: fraction of non-gap characters that are IUPAC ambiguity
+        codes (N, R, Y, ...), case-insensitive.
+        gc: GC content, over unambiguous bases (A, C, G, T/U) only.
+    Fractions are NaN when their denominator is 0.
+    """
+    if any(len(ch) != 1 for ch in char_ls):
+        raise ValueError("seq_metrics() only supports single characters in char_ls")
+
+    removed = _char_mask(char_ls)
+    gaps = _char_mask("-.")
+    ambig = _char_mask("RYSWKMBDHVNryswkmbdhvn")
+    gc = _char_mask("GCgc")
+    acgt = _char_mask("ACGTUacgtu")
+
+    # ids*256 + codes has to fit in an int32
+    chunk_residues = max(1, min(int(chunk_residues), np.iinfo(np.int32).max // 256 - 1))
+    n_seq = len(seq_ls)
+    all_lens = np.fromiter((len(seq) for seq in seq_ls), dtype=np.int64, count=n_seq)
+    counts = {"aln_len": all_lens}
+    for col in ["removed", "gaps", "ambig", "gc", "acgt"]:
+        counts[col] = np.zeros(n_seq, dtype=np.int64)
+
+    for i0, i1 in _residue_chunks(all_lens, chunk_residues):
+        chunk = seq_ls[i0:i1]
+        lens = all_lens[i0:i1]
+        codes = np.frombuffer("".join(chunk).encode('latin-1'), dtype=np.uint8)
+        ids = np.repeat(np.arange(len(chunk), dtype=np.int32), lens)
+        ids *= 256
+        ids += codes
+        char_counts = np.bincount(ids, minlength=len(chunk)*256).reshape(len(chunk), 256)
+
+        sl = slice(i0, i1)
+        counts["removed"][sl] = char_counts[:, removed].sum(axis=1)
+        counts["gaps"][sl] = char_counts[:, gaps].sum(axis=1)
+        counts["ambig"][sl] = char_counts[:, ambig].sum(axis=1)
+        counts["gc"][sl] = char_counts[:, gc].sum(axis=1)
+        counts["acgt"][sl] = char_counts[:, acgt].sum(axis=1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        metrics = pd.DataFrame({
+            "aln_len": counts["aln_len"],
+            "len": counts["aln_len"] - counts["removed"],
+            "gap_frac": counts["gaps"] / counts["aln_len"],
+            "ambig_frac": counts["ambig"] / (counts["aln_len"] - counts["gaps"]),
+            "gc": counts["gc"] / counts["acgt"]})
+    return metrics
+
+
+def _residue_chunks(lens, chunk_residues):
+    """Splits sequences into consecutive (i0, i1) ranges of at most
+    chunk_residues residues, counting each sequence as 1 extra. A sequence
+    longer than chunk_residues gets a range of its own.
+    """
+    chunks = []
+    cost = np.cumsum(lens + 1)
+    i0 = 0
+    while i0 < len(lens):
+        base = cost[i0 - 1] if i0 > 0 else 0
+        i1 = int(np.searchsorted(cost, base + chunk_residues, side='right'))
+        i1 = max(i1, i0 + 1)
+        chunks.append((i0, i1))
+        i0 = i1
+    return chunks
+
+
+def _char_mask(chars):
+    """Boolean mask over the 256 byte values, True for the given characters."""
+    mask = np.zeros(256, dtype=bool)
+    mask[list(ord(ch) for ch in chars)] = True
+    return mask
+
+
+def hist_median(hist):
+    """Exact median of a set of non-negative integers (e.g. sequence
+    lengths), given only their histogram, hist[v] = no. of occurrences of v.
+    Matches np.median() of the values themselves.
+    """
+    cum = np.cumsum(hist)
+    n = cum[-1] if len(cum) > 0 else 0
+    if n == 0:
+        return np.nan
+    # values at sorted positions (n-1)//2 and n//2
+    lo = np.searchsorted(cum, (n-1)//2, side='right')
+    hi = np.searchsorted(cum, n//2, side='right')
+    return (lo + hi)/2
+
+
+def msa_screen(df, seq_col, min_len=0.8, char_ls=["-", "n"], id_col="name_id",
+               verbose=True):
     """Returns a whole bunch of info about a given fasta file, input as a df.
-    Returns nothing; only prints stuff out.
+    Prints a summary, and returns a table of per-sequence metrics.
 
     Params
     ------
@@ -333,34 +1640,36 @@ def msa_screen(df, seq_col, min_len=0.8, char_ls=["-", "n"]):
     seq_col: name of the sequence column
     min_len: minimum percentage length of median length required. Sequences
     shorter than this threshold will be shown and recommended for deletion.
-    """
+    char_ls: list of single characters to ignore when computing lengths.
+    id_col: name of the column identifying each sequence.
+    verbose: boolean; prints the summary and the short seqs when True.
 
-    # replace gapped length
-    seq_ls = list(df[seq_col])
-    seq_len_ls = []
-    for i in range(len(seq_ls)):
-        seq_ls[i] = replace_chars(char_ls, "", seq_ls[i])
-        seq_len_ls.append(len(seq_ls[i]))
+    Returns
+    -------
+    metrics: dataframe with the same index as df, with id_col, the columns
+    of seq_metrics(), 'pct median len', and 'short' (True for sequences
+    recommended for deletion).
+    """
+    metrics = seq_metrics(list(df[seq_col]), char_ls=char_ls)
+    metrics.index = df.index
+    if id_col in df.columns:
+        metrics.insert(0, id_col, df[id_col])
 
-    seq_len_ls = np.array(seq_len_ls)
-    df["ungapped_seq"] = seq_ls
+    seq_len_ls = metrics["len"].values
     medi = np.median(seq_len_ls)
-    print("Average seq len = %.3f" % np.average(seq_len_ls))
-    print("Median seq len = %s" % medi)
-    print("Minimum seq len required = %s" % int(medi*min_len))
-    print("")
-
-    d_p_contents = []
-    for index, row in df.iterrows():
-        if len(row["ungapped_seq"]) < int(medi*min_len):
-            d_p_contents.append([row["name_id"],
-            len(row["ungapped_seq"]),
-            len(row["ungapped_seq"])/medi])
-
-    d_p = pd.DataFrame(data=d_p_contents, columns=["name_id",
-    "len",
-    "pct median len"])
-
-    if d_p.shape[0] > 0:
-        print("Short seqs (< min length required)")
-        print(d_p)
+    metrics["pct median len"] = seq_len_ls / medi
+    metrics["short"] = seq_len_ls < int(medi*min_len)
+
+    if verbose:
+        print("Average seq len = %.3f" % np.average(seq_len_ls))
+        print("Median seq len = %s" % medi)
+        print("Minimum seq len required = %s" % int(medi*min_len))
+        print("")
+
+        d_p = metrics.loc[metrics["short"], [col for col in [id_col, "len", "pct median len"]
+                                             if col in metrics.columns]]
+        if d_p.shape[0] > 0:
+            print("Short seqs (< min length required)")
+            print(d_p.reset_index(drop=True))
+
+    return metrics